@@ -0,0 +1,247 @@
+import asyncio
+from multiprocessing import Process
+from multiprocessing.sharedctypes import RawArray
+import time
+import frame_layout
+import result_collector
+import ring_memory
+import tracing
+from shared_buffer import SharedRingBuffer
+from video_reader import shm_producer, shm_worker
+
+### asyncio front end of the shared ring. Producers (and workers, when a
+### function is given) are the usual processes and the event loop is the
+### only reader of the rings it iterates. They have a wakeup pipe watched
+### with loop.add_reader, and process sentinels tell the loop when
+### producers and workers exit: nothing is polled and the loop never blocks
+### on a semaphore, so it keeps serving other tasks while frames decode.
+
+async def _readable(fd):
+    ''' Return as soon as fd is readable '''
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    loop.add_reader(fd, ready.set)
+    try:
+        await ready.wait()
+    finally:
+        loop.remove_reader(fd)
+
+class AsyncVideoReader:
+
+    def __init__(
+        self,
+        reader,
+        fn = None,
+        n_workers = 1,
+        prefetch = 16,
+        n_producers = 1,
+        result_dtype = None,
+        window = 4096,
+        batch_size = 1,
+        huge_pages = None,
+        prefault = False,
+        trace = None
+    ):
+        '''
+        Iterate a video_reader.VideoReader from asyncio:
+
+            async with AsyncVideoReader(reader) as frames:
+                async for frame_num, frame in frames:
+                    ...
+
+        yields copies of the frames in order. With fn, frames are processed
+        by n_workers processes and (frame_num, fn(frame, frame_num)) is
+        yielded instead, result_dtype is then required.
+
+        Leaving the async with block (break, exception, task cancellation)
+        terminates producers and workers at once, a bare async for only
+        does it when the loop finalizes the iteration.
+
+        prefetch: frames decoded ahead of the loop (ring slots), producers
+            wait when it is reached. Also in bytes, e.g. '1G'
+        n_producers: decode keyframe-aligned chunks in parallel. Without fn
+            each producer has its own ring of prefetch frames, read in chunk
+            order: producers of later chunks wait on their full ring until
+            their turn. With fn, results of later chunks (not frames) are
+            held in memory until the earlier chunks are done, later chunks
+            pause window frames ahead of the next result in order, see
+            result_collector.ReorderWindow
+        batch_size: frames per ring slot, fn then gets (count, ...) batches
+            and their frame numbers, like VideoReader.process. Frames are
+            still yielded one by one
+        huge_pages, prefault: how the frame rings are allocated, see
+            ring_memory.RingMemory
+        trace: a tracing.Tracer, without fn the copy out of the ring is
+            traced as the processing of worker 0
+        '''
+        if fn is not None and result_dtype is None:
+            raise ValueError('result_dtype is needed to collect results')
+        self.reader = reader
+        self.fn = fn
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self.n_producers = n_producers
+        self.result_dtype = result_dtype
+        self.window = window
+        self.batch_size = batch_size
+        self.huge_pages = huge_pages
+        self.prefault = prefault
+        self.trace = trace
+        self.producers = []
+        self.workers = []
+        self._started = False
+        self._closed = False
+
+    def start(self):
+        ''' Start producers and workers, done by the first iteration '''
+        if self._started:
+            return
+        self._started = True
+
+        ranges = self.reader._chunks(self.n_producers)
+        self.frame_counts = RawArray('q', len(ranges))
+        dtype = frame_layout.batch_dtype(
+            self.reader.shape, self.reader.dtype, self.batch_size
+        )
+        memory = {'huge_pages': self.huge_pages, 'prefault': self.prefault}
+        size = ring_memory.capacity(self.prefetch, dtype.itemsize) + 1
+        self.output = None
+        self.reorder_window = None
+        if self.fn is None:
+            # one ring per chunk, read in order
+            self.rings = [
+                SharedRingBuffer(size, dtype=dtype, notify=True, **memory)
+                for r in ranges
+            ]
+        else:
+            # workers take frames of any chunk, results are reordered
+            self.rings = [SharedRingBuffer(size, dtype=dtype, **memory)] * len(ranges)
+            if self.window is not None and len(ranges) > 1:
+                self.reorder_window = result_collector.ReorderWindow(self.window)
+            self.output = SharedRingBuffer(
+                size,
+                dtype=result_collector.result_dtype((), self.result_dtype),
+                notify=True
+            )
+            self.workers = [
+                Process(
+                    target=shm_worker,
+                    args=(self.rings[0], self.fn, self.output, i, False, None,
+                            self.trace)
+                )
+                for i in range(self.n_workers)
+            ]
+        self.producers = [
+            Process(
+                target=shm_producer,
+                args=(self.reader._spec(), start, stop, self.rings[i],
+                        self.frame_counts, i, False, self.trace, 0,
+                        self.reorder_window)
+            )
+            for i, (start, stop) in enumerate(ranges)
+        ]
+        for p in self.workers + self.producers:
+            p.start()
+        self._supervisor = asyncio.ensure_future(self._supervise())
+
+    async def _supervise(self):
+        # end of stream is signaled when processes exit, not polled
+        async def close(p, ring):
+            await _readable(p.sentinel)
+            if self.fn is None:
+                ring.close()
+        await asyncio.gather(*(
+            close(p, ring) for p, ring in zip(self.producers, self.rings)
+        ))
+        if self.workers:
+            self.rings[0].close()
+            await asyncio.gather(*(_readable(p.sentinel) for p in self.workers))
+            self.output.close()
+
+    async def _acquire(self, ring):
+        # (ok, index, slot) of the next item, ok is False at the end
+        while True:
+            # commits write to the pipe after making the slot available, so
+            # an item committed after this check always wakes us up
+            ring.clear_wakeup()
+            ok, index, slot = ring.acquire_read_slot(block=False, timeout=0)
+            if ok or (ring.closed() and ring.empty()):
+                return ok, index, slot
+            await _readable(ring.fileno())
+
+    def _items(self, ring, index, slot):
+        # copy out of the slot, it is released as soon as we return
+        if self.output is not None:
+            items = [(int(slot['frame_num']), slot['result'].copy())]
+            ring.release(index)
+            return items
+        count = int(slot['count'])
+        if self.trace is not None:
+            self.trace.dequeued(slot['header']['index'][:count], 0, time.monotonic())
+        items = [
+            (int(slot['header']['index'][i]), slot['frame'][i].copy())
+            for i in range(count)
+        ]
+        ring.release(index)
+        if self.trace is not None:
+            frame_nums = [frame_num for frame_num, frame in items]
+            self.trace.stamp_many(frame_nums, tracing.PROCESS)
+            self.trace.stamp_many(frame_nums, tracing.DONE)
+        return items
+
+    async def __aiter__(self):
+        self.start()
+        try:
+            if self.output is None:
+                # each ring has one producer, its frames come in order
+                for ring in self.rings:
+                    while True:
+                        ok, index, slot = await self._acquire(ring)
+                        if not ok:
+                            break
+                        for item in self._items(ring, index, slot):
+                            yield item
+            else:
+                reorder = result_collector.ReorderBuffer()
+                while True:
+                    ok, index, slot = await self._acquire(self.output)
+                    if not ok:
+                        break
+                    for item in self._items(self.output, index, slot):
+                        for frame_num, value in reorder.push(*item):
+                            yield frame_num, value
+                    if self.reorder_window is not None:
+                        self.reorder_window.advance(reorder.next)
+                for frame_num, value in reorder.flush():
+                    yield frame_num, value
+        finally:
+            # break out of the loop, exceptions and task cancellation
+            await self.aclose()
+
+    @property
+    def num_frames(self):
+        ''' Number of frames decoded, once iteration is over '''
+        return sum(self.frame_counts)
+
+    async def aclose(self):
+        ''' Stop producers and workers, frames not read yet are dropped '''
+        if not self._started or self._closed:
+            return
+        self._closed = True
+        processes = self.producers + self.workers
+        for p in processes:
+            # blocked on a full ring, or still decoding
+            if p.is_alive():
+                p.terminate()
+        # the supervisor returns once they have all exited, without blocking
+        # the loop
+        await self._supervisor
+        for p in processes:
+            p.join()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
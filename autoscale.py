@@ -0,0 +1,143 @@
+from multiprocessing.sharedctypes import RawArray, RawValue
+import os
+import time
+import warnings
+
+### Adjust the number of consumer processes while a video is processed,
+### instead of sweeping -n, --queuesize and OMP_NUM_THREADS by hand.
+###
+### Every `interval` seconds the controller looks at
+###   - ring occupancy: fraction of the frame buffer waiting to be processed
+###   - producer stall: fraction of time producers waited for a free slot
+###   - consumer idle: fraction of time consumers waited for a frame
+### A full ring or stalled producers mean consumers are the bottleneck: add
+### one. Idle consumers with an empty ring mean decoding is the bottleneck:
+### retire one, its core is better used by BLAS threads of the others.
+
+def has_threadpoolctl():
+    ''' True if BLAS threads can be limited in a running process '''
+    try:
+        import threadpoolctl
+    except ImportError:
+        return False
+    return True
+
+def set_blas_threads(n):
+    '''
+    Limit BLAS/OpenMP threads of the calling process with threadpoolctl and
+    return True. Without threadpoolctl, warns and sets the environment
+    variables, which only affects processes that have not loaded BLAS yet
+    (numpy loads it on import), and returns False.
+    '''
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        warnings.warn(
+            "threadpoolctl is not installed, BLAS threads of running "
+            "processes are not limited (pip install threadpoolctl)",
+            RuntimeWarning,
+            stacklevel=2
+        )
+        for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+            os.environ[var] = str(n)
+        return False
+    threadpool_limits(n)
+    return True
+
+class WorkerControl:
+
+    def __init__(self, max_workers):
+        ''' Shared flags telling each worker to stop, and its thread budget '''
+        self.stop_flags = RawArray('b', max_workers)
+        self.blas_threads = RawValue('i', 0)
+        self._applied = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_applied'] = 0
+        return state
+
+    def should_stop(self, process_num):
+        return self.stop_flags[process_num] == 1
+
+    def apply_threads(self):
+        ''' Called by workers between frames, cheap when nothing changed '''
+        n = self.blas_threads.value
+        if n > 0 and n != self._applied:
+            set_blas_threads(n)
+            self._applied = n
+
+class Autoscaler:
+
+    def __init__(
+        self,
+        min_workers = 1,
+        max_workers = None,
+        interval = 0.5,
+        high = 0.75,
+        low = 0.1,
+        idle = 0.5,
+        stall = 0.2,
+        cores = None,
+        split_threads = True
+    ):
+        '''
+        high/low: ring occupancy above which workers are added, below which
+            they can be retired
+        idle: consumer idle fraction above which a worker can be retired
+        stall: producer stall fraction above which a worker is added
+        split_threads: give each worker cores // n_workers BLAS threads
+        '''
+        self.cores = cores or os.cpu_count()
+        self.min_workers = min_workers
+        self.max_workers = max_workers or self.cores
+        self.interval = interval
+        self.high = high
+        self.low = low
+        self.idle = idle
+        self.stall = stall
+        self.split_threads = split_threads
+        # (time, n_workers, occupancy, stall, idle) at each step
+        self.history = []
+        self._last = None
+
+    def threads_per_worker(self, n_workers):
+        return max(1, self.cores // max(1, n_workers))
+
+    def sample(self, frame_buffer, n_producers, n_workers):
+        ''' Return (occupancy, stall fraction, idle fraction) since last call '''
+
+        now = time.monotonic()
+        # waits in progress are included, a long wait is spread over the
+        # intervals it covers instead of landing in the one where it ends
+        write_wait, read_wait = frame_buffer.wait_time()
+        occupancy = frame_buffer.size() / frame_buffer.maxNumItems
+        if self._last is None:
+            self._last = (now, write_wait, read_wait)
+            return occupancy, 0.0, 0.0
+
+        t0, write_wait0, read_wait0 = self._last
+        self._last = (now, write_wait, read_wait)
+        dt = max(now - t0, 1e-6)
+        stall = (write_wait - write_wait0) / (dt * max(1, n_producers))
+        idle = (read_wait - read_wait0) / (dt * max(1, n_workers))
+        # retired workers may still be waiting, they are not in n_workers
+        stall = min(max(stall, 0.0), 1.0)
+        idle = min(max(idle, 0.0), 1.0)
+        return occupancy, stall, idle
+
+    def decide(self, occupancy, stall, idle, n_workers):
+        ''' Return +1 to add a worker, -1 to retire one, 0 to keep them '''
+
+        if (occupancy > self.high or stall > self.stall) and \
+                n_workers < self.max_workers:
+            return 1
+        if occupancy < self.low and idle > self.idle and \
+                n_workers > self.min_workers:
+            return -1
+        return 0
+
+    def step(self, frame_buffer, n_producers, n_workers):
+        occupancy, stall, idle = self.sample(frame_buffer, n_producers, n_workers)
+        self.history.append((time.monotonic(), n_workers, occupancy, stall, idle))
+        return self.decide(occupancy, stall, idle, n_workers)
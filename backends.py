@@ -0,0 +1,331 @@
+import os
+import time
+import numpy as np
+
+### Frame sources. cv2 is only imported when a source is opened, so that
+### importing the library stays fast and backends can be chosen at runtime.
+###
+### Every source exposes shape, dtype, num_frames and
+###   read(out=None) -> (ok, frame, pts)
+### which decodes the next frame, into `out` when given (zero copy when the
+### backend allows it), pts is in milliseconds or nan if unknown.
+### decode_ts is the time.monotonic() at which the last frame was decoded,
+### before color conversion, used by tracing.
+###
+### With luma=True, grayscale frames are the decoder's Y plane instead of
+### YUV -> BGR -> gray: two full frame conversions less per frame. Values
+### are then video range luma (16-235) rather than the full range gray of
+### cvtColor, which is why it is opt-in with the OpenCV backends.
+
+def _into(frame, out):
+    # OpenCV reallocates dst when shape or type do not match
+    if out is not None and frame is not out and not np.shares_memory(frame, out):
+        out[...] = frame
+        return out
+    return frame
+
+def _crop(frame, height, width, out=None):
+    # decoders pad rows to an aligned stride (and sometimes add rows), keep
+    # the visible height x width part
+    frame = frame[:height, :width]
+    if out is None:
+        return np.ascontiguousarray(frame)
+    return _into(frame, out)
+
+# codec pixel formats (fourcc) whose first plane is 8-bit luma
+LUMA_FOURCC = ('I420', 'IYUV', 'YV12', 'NV12', 'NV21', 'Y42B', '444P', 'Y41B',
+                'Y800', 'GREY')
+
+class OpenCVSource:
+
+    def __init__(self, videofile, color=False, use_gpu=False, luma=False):
+        '''
+        Decode with cv2.VideoCapture (FFMPEG), use_gpu selects h264_cuvid.
+        luma: gray frames are the Y plane, decoded with CAP_PROP_CONVERT_RGB
+        off. Ignored when the pixel format is not 8-bit YUV.
+        '''
+
+        import cv2
+        self._cv2 = cv2
+
+        # Hardware acceleration on NVIDIA GPU
+        if use_gpu:
+            os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"]="video_codec;h264_cuvid"
+        self.luma = luma and not color
+        params = []
+        if self.luma:
+            # OpenCV warns on every frame that it does not know the format
+            cv2.utils.logging.setLogLevel(cv2.utils.logging.LOG_LEVEL_ERROR)
+            params = [cv2.CAP_PROP_CONVERT_RGB, 0]
+        self.cap = cv2.VideoCapture(videofile, cv2.CAP_FFMPEG, params)
+        if not self.cap.isOpened():
+            raise IOError('could not open ' + videofile)
+        if self.luma:
+            fourcc = int(self.cap.get(cv2.CAP_PROP_CODEC_PIXEL_FORMAT))
+            fourcc = fourcc.to_bytes(4, 'little').decode('ascii', 'replace')
+            if (self.cap.get(cv2.CAP_PROP_CONVERT_RGB) != 0 or
+                    fourcc not in LUMA_FOURCC):
+                # unknown layout, back to BGR and cvtColor
+                self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                self.luma = False
+
+        self.color = color
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.num_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if color:
+            self.shape = (self.height, self.width, 3)
+        else:
+            self.shape = (self.height, self.width)
+        self.dtype = np.dtype(np.uint8)
+        self.decode_ts = np.nan
+
+    def read(self, out=None):
+        cv2 = self._cv2
+        if self.color:
+            rval, frame = self.cap.read(out)
+            self.decode_ts = time.monotonic()
+        elif self.luma:
+            # the Y plane is decoded straight into out
+            rval, frame = self.cap.read(out)
+            self.decode_ts = time.monotonic()
+            if rval:
+                frame = _crop(frame, self.height, self.width, out)
+        else:
+            rval, frame = self.cap.read()
+            self.decode_ts = time.monotonic()
+            if rval:
+                frame = cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY,dst=out)
+        if not rval:
+            return False, None, np.nan
+        return True, _into(frame, out), self.cap.get(cv2.CAP_PROP_POS_MSEC)
+
+    def seek(self, frame_index):
+        ''' Next read returns frame frame_index (0-based) '''
+        self.cap.set(self._cv2.CAP_PROP_POS_FRAMES, frame_index)
+
+    def release(self):
+        self.cap.release()
+
+class CudaCodecSource:
+
+    def __init__(self, videofile, color=False, host=True, luma=False):
+        '''
+        Decode on NVIDIA GPU with cv2.cudacodec. With host=False frames stay
+        in GPU memory as cv2.cuda.GpuMat and cannot be shared with other
+        processes. luma: gray frames are the decoder's luma plane, when the
+        cudacodec version supports ColorFormat_GRAY.
+        '''
+
+        import cv2
+        self._cv2 = cv2
+
+        # frame size is probed on the CPU, cudacodec frames are padded
+        cap = cv2.VideoCapture(videofile, cv2.CAP_FFMPEG)
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+        self.cap = cv2.cudacodec.createVideoReader(videofile)
+        self.luma = False
+        if luma and not color:
+            try:
+                self.luma = bool(self.cap.set(cv2.cudacodec.ColorFormat_GRAY))
+            except (AttributeError, cv2.error):
+                pass
+        self.color = color
+        self.host = host
+        if color:
+            self.shape = (self.height, self.width, 3)
+        else:
+            self.shape = (self.height, self.width)
+        self.dtype = np.dtype(np.uint8)
+        self.decode_ts = np.nan
+
+    def read(self, out=None):
+        cv2 = self._cv2
+        rval, frame = self.cap.nextFrame()
+        self.decode_ts = time.monotonic()
+        if not rval:
+            return False, None, np.nan
+
+        if self.color:
+            frame = cv2.cuda.cvtColor(frame,cv2.COLOR_BGRA2BGR)
+        elif not self.luma:
+            frame = cv2.cuda.cvtColor(frame,cv2.COLOR_BGRA2GRAY)
+        if self.host:
+            # decoded frames are padded to the decoder's surface size
+            frame = _crop(frame.download(), self.height, self.width, out)
+        return True, frame, np.nan
+
+    def seek(self, frame_index):
+        raise NotImplementedError('cudacodec cannot seek')
+
+    def release(self):
+        pass
+
+class CacheSource:
+
+    def __init__(self, videofile, color=False, cache=None, source='cpu',
+                    **options):
+        '''
+        Replay frames from a frame_cache.FrameCache, the video is decoded
+        with the `source` backend and cached on first use
+        '''
+
+        import frame_cache
+        if cache is None:
+            cache = frame_cache.FrameCache()
+        self.entry = cache.get(videofile, color, source, **options)
+        self.frames = frame_cache.open_frames(self.entry)
+        self.pts = self.entry['pts']
+        self.color = color
+        self.shape = tuple(self.entry['shape'])
+        self.dtype = np.dtype(self.entry['dtype'])
+        self.num_frames = self.entry['num_frames']
+        self.position = 0
+        self.decode_ts = np.nan
+
+    def read(self, out=None):
+        if self.position >= self.num_frames:
+            return False, None, np.nan
+        frame = self.frames[self.position]
+        if out is not None:
+            out[...] = frame
+            frame = out
+        pts = self.pts[self.position]
+        self.position += 1
+        self.decode_ts = time.monotonic()
+        return True, frame, np.nan if pts is None else pts
+
+    def seek(self, frame_index):
+        self.position = frame_index
+
+    def release(self):
+        self.frames = None
+
+# pixel formats whose first plane is 8-bit luma
+LUMA_FORMATS = (
+    'gray', 'yuv420p', 'yuvj420p', 'yuv422p', 'yuvj422p', 'yuv444p',
+    'yuvj444p', 'yuv411p', 'yuv410p', 'yuv440p', 'yuvj440p', 'nv12', 'nv21'
+)
+
+def _plane(plane, height, width, out):
+    # rows of a libav plane are line_size bytes apart
+    rows = np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)
+    return _crop(rows, height, width, out)
+
+class PyAVSource:
+
+    def __init__(self, videofile, color=False, threads=0, thread_type='AUTO',
+                    keyframes_only=False, every=1, luma=True):
+        '''
+        Decode with PyAV (libav). threads: decoder threads, 0 for auto.
+        thread_type: 'FRAME', 'SLICE' or 'AUTO'. keyframes_only: decode
+        keyframes only, the decoder skips every non-key frame, for fast
+        previews. every: keep one frame
+        out of every. luma: gray frames are the decoder's luma plane, the
+        default here since libav gives direct access to it.
+        '''
+
+        import av
+        self.container = av.open(videofile)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = thread_type
+        self.stream.thread_count = threads
+        if keyframes_only:
+            self.stream.codec_context.skip_frame = 'NONKEY'
+
+        self.color = color
+        self.luma = luma
+        self.every = every
+        self.width = self.stream.codec_context.width
+        self.height = self.stream.codec_context.height
+        self.rate = self.stream.average_rate or self.stream.guessed_rate
+        num_frames = self.stream.frames
+        if num_frames == 0 and self.stream.duration and self.rate:
+            num_frames = int(self.stream.duration * self.stream.time_base * self.rate)
+        # upper bound with keyframes_only
+        self.num_frames = -(-num_frames // every)
+        if color:
+            self.shape = (self.height, self.width, 3)
+        else:
+            self.shape = (self.height, self.width)
+        self.dtype = np.dtype(np.uint8)
+        self.decode_ts = np.nan
+
+        self._frames = self.container.decode(self.stream)
+        self._pending = None
+        self._decoded = 0
+
+    def _next(self):
+        if self._pending is not None:
+            frame, self._pending = self._pending, None
+            return frame
+        return next(self._frames, None)
+
+    def read(self, out=None):
+        while True:
+            frame = self._next()
+            if frame is None:
+                return False, None, np.nan
+            self._decoded += 1
+            if (self._decoded - 1) % self.every == 0:
+                break
+        self.decode_ts = time.monotonic()
+
+        if self.color:
+            image = _into(frame.to_ndarray(format='bgr24'), out)
+        elif self.luma and frame.format.name in LUMA_FORMATS:
+            image = _plane(frame.planes[0], self.height, self.width, out)
+        else:
+            image = _into(frame.to_ndarray(format='gray'), out)
+        pts = np.nan if frame.pts is None else 1000 * float(frame.time)
+        return True, image, pts
+
+    def seek(self, frame_index):
+        ''' Next read returns frame frame_index (0-based, constant frame rate) '''
+        time_base = self.stream.time_base
+        start = self.stream.start_time or 0
+        target = start + int(round(frame_index / self.rate / time_base))
+        half_frame = 0.5 / self.rate / time_base
+        # lands on the preceding keyframe, decode forward to the target
+        self.container.seek(target, backward=True, any_frame=False,
+                            stream=self.stream)
+        self._frames = self.container.decode(self.stream)
+        self._pending = None
+        self._decoded = 0
+        for frame in self._frames:
+            if frame.pts is None or frame.pts >= target - half_frame:
+                self._pending = frame
+                break
+
+    def release(self):
+        self.container.close()
+
+def open_source(videofile, backend='cpu', color=False, preprocess=None,
+                    **options):
+    '''
+    Open a frame source, backend is one of cpu, cuvid, cudacodec, pyav, cache.
+    With a preprocessing.Preprocess, frames are decoded in color then
+    cropped, converted, resized and cast by the source.
+    '''
+
+    if preprocess is not None:
+        import preprocessing
+        source = open_source(videofile, backend, True, **options)
+        return preprocessing.PreprocessedSource(source, preprocess, color)
+
+    if backend == 'cpu':
+        return OpenCVSource(videofile, color, **options)
+    elif backend == 'cuvid':
+        return OpenCVSource(videofile, color, use_gpu=True, **options)
+    elif backend == 'cudacodec':
+        return CudaCodecSource(videofile, color, **options)
+    elif backend == 'pyav':
+        return PyAVSource(videofile, color, **options)
+    elif backend == 'cache':
+        return CacheSource(videofile, color, **options)
+    else:
+        raise ValueError('unknown backend ' + str(backend))
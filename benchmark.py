@@ -1,78 +1,306 @@
 #!/usr/bin/env python3
 
-import time
-import subprocess
+import argparse
+import csv
+import json
 import os
+import resource
+import sys
+import time
+import numpy as np
+import utils
+from autoscale import has_threadpoolctl, set_blas_threads
+from tracing import Tracer, START, DONE
+from video_reader import VideoReader
+
+### Benchmark the reading strategies in this process, on synthetic videos
+### generated locally, so that runs are reproducible on any machine.
+###
+### Sweeps resolution x codec x strategy x consumers x OMP threads x queue
+### size x load x batch size, repeats every configuration and reports FPS,
+### per-frame latency percentiles and CPU utilization as JSON and CSV.
+### With --baseline, median FPS is compared with a previous JSON report and
+### the script exits with status 1 if a configuration got slower.
+###
+### Latency is measured around the processing function in the workers: the
+### time a frame spends in process_fun, and the interval between two
+### consecutive frame completions (stalls show up in its p99). End-to-end
+### latency, from the start of decoding to the end of processing, comes
+### from tracing.Tracer.
+###
+### OMP threads are limited with threadpoolctl, BLAS is already loaded when
+### the workers start. Without it --omp is refused and runs are reported
+### with omp=0, BLAS threads not limited.
+
+LOADS = {
+    'N': utils.do_nothing,
+    'L': utils.synthetic_load_light,
+    'SC': utils.synthetic_load_single_core,
+    'MC': utils.synthetic_load_multi_core
+}
+
+CODECS = {
+    # fourcc: container
+    'mp4v': '.mp4',
+    'MJPG': '.avi',
+    'XVID': '.avi'
+}
 
-my_env = os.environ.copy()
-
-videofile = '../jumanji_short.mp4'
-
-for omp in range(1,17):
-    
-    # MATLAB naive
-    start = time.time()
-    subprocess.run(
-         ['matlab',
-         '-nodesktop',
-         '-nosplash',
-         '-r',
-         "naive('../jumanji_short.mp4'," + str(omp) + "); exit"],
-         capture_output=True
+# a configuration is identified by these fields, everything else is measured
+KEY = ['resolution', 'codec', 'strategy', 'consumers', 'omp', 'queue_size',
+        'load', 'batch']
+MEASURED = ['frames', 'seconds', 'fps', 'latency_p50_ms', 'latency_p99_ms',
+        'interval_p50_ms', 'interval_p99_ms', 'e2e_p50_ms', 'e2e_p99_ms',
+        'cpu_percent']
+
+def generate_video(path, width, height, codec, num_frames, fps=30):
+    '''
+    Write a deterministic test video: a moving gradient with noise, so that
+    the encoder (and decoder) has real work to do
+    '''
+    import cv2
+
+    writer = cv2.VideoWriter(
+        path,
+        cv2.VideoWriter_fourcc(*codec),
+        fps,
+        (width, height)
     )
-    stop = time.time()
-    duration = (stop-start)                                             
-    print("naive('../jumanji_short.mp4'," + str(omp) + "); exit : " + str(duration))
-
-    # Python naive 
-    for gpu in [True, False]:
-        my_env['OMP_NUM_THREADS'] = str(omp)
-        start = time.time()
-        if gpu:
-            subprocess.run(
-                ['./naive.py','../jumanji_short.mp4','--gpu'],
-                env=my_env,
-                capture_output=True
-            )
-            stop = time.time()
-            duration = (stop-start)
-            print('OMP_NUM_THREADS=' + str(omp) + ' ./naive.py ../jumanji_short.mp4 --gpu : ' + str(duration))
-        else:
-            subprocess.run(
-                ['./naive.py','../jumanji_short.mp4'],
-                env=my_env,
-                capture_output=True
-            ) 
-            stop = time.time()
-            duration = (stop-start)
-            print('OMP_NUM_THREADS=' + str(omp) + ' ./naive.py ../jumanji_short.mp4 : ' + str(duration))
-
-
-for n_consumers in range(1,17):
-    for omp in range(1 ,17):
-        my_env['OMP_NUM_THREADS'] = str(omp)
-        for gpu in [True, False]:
-            start = time.time()
-            if gpu:
-                subprocess.run(
-                    ['./producer_consumer.py',
-                    '../jumanji_short.mp4',
-                    '-n ' + str(n_consumers),
-                    '--gpu'],
-                    env=my_env,
-                    capture_output=True
+    if not writer.isOpened():
+        raise IOError('cannot encode ' + codec + ' with this OpenCV build')
+
+    rng = np.random.default_rng(0)
+    x = np.arange(width, dtype=np.float32)[None, :]
+    y = np.arange(height, dtype=np.float32)[:, None]
+    for i in range(num_frames):
+        gradient = (x + y + 4*i) % 256
+        noise = rng.integers(0, 32, (height, width), dtype=np.uint8)
+        gray = (gradient.astype(np.uint8) + noise)
+        frame = np.dstack([gray, np.roll(gray, i, axis=1), 255 - gray])
+        writer.write(frame)
+    writer.release()
+
+def test_video(directory, resolution, codec, num_frames):
+    ''' Return the path of a synthetic video, generate it if needed '''
+    width, height = resolution
+    path = os.path.join(
+        directory,
+        '{0}x{1}_{2}_{3}{4}'.format(width, height, codec, num_frames, CODECS[codec])
+    )
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        generate_video(path, width, height, codec, num_frames)
+    return path
+
+class TimedLoad:
+    '''
+    Wrap a load function to return (start, stop) time.monotonic() of each
+    frame, monotonic time is shared by all processes. BLAS threads are
+    limited in each worker on first call, unless omp is 0.
+    '''
+
+    def __init__(self, load, omp):
+        self.load = load
+        self.omp = omp
+        self._limited = False
+
+    def __call__(self, frame, frame_num):
+        if not self._limited:
+            if self.omp:
+                set_blas_threads(self.omp)
+            self._limited = True
+        start = time.monotonic()
+        self.load(frame, frame_num)
+        stop = time.monotonic()
+        if np.ndim(frame_num) == 0:
+            return (start, stop)
+        # batch: one result per frame
+        return [(start, stop)] * len(frame_num)
+
+def cpu_time():
+    # children are accounted for once they have been joined
+    total = 0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+def run(videofile, config):
+    ''' Run one configuration, return the measurements '''
+
+    reader = VideoReader(videofile)
+    fn = TimedLoad(LOADS[config['load']], config['omp'])
+    timings = []
+    tracer = None
+
+    cpu_start = cpu_time()
+    start = time.perf_counter()
+    if config['strategy'] == 'naive':
+        if config['omp']:
+            set_blas_threads(config['omp'])
+        for frame_num, frame in reader:
+            timings.append(fn(frame, frame_num))
+        num_frames = len(timings)
+    else:
+        tracer = Tracer(int(reader.num_frames * 1.1) + 100)
+        num_frames = reader.process(
+            fn,
+            config['consumers'],
+            transport = config['strategy'],
+            queue_size = config['queue_size'],
+            batch_size = config['batch'],
+            result_dtype = np.dtype((np.float64, (2,))),
+            results = lambda frame_num, result: timings.append(tuple(result)),
+            trace = tracer
+        )
+    duration = time.perf_counter() - start
+    cpu = cpu_time() - cpu_start
+
+    timings = np.array(timings).reshape(-1, 2)
+    latency = timings[:,1] - timings[:,0]
+    interval = np.diff(np.sort(timings[:,1]))
+    if len(interval) == 0:
+        interval = np.zeros(1)
+    e2e = np.full(1, np.nan)
+    if tracer is not None:
+        times = tracer.views()[0]
+        complete = times[(times[:,START] > 0) & (times[:,DONE] > 0)]
+        if len(complete):
+            e2e = complete[:,DONE] - complete[:,START]
+    return {
+        'frames': int(num_frames),
+        'seconds': duration,
+        'fps': num_frames / duration,
+        'latency_p50_ms': 1000 * float(np.percentile(latency, 50)),
+        'latency_p99_ms': 1000 * float(np.percentile(latency, 99)),
+        'interval_p50_ms': 1000 * float(np.percentile(interval, 50)),
+        'interval_p99_ms': 1000 * float(np.percentile(interval, 99)),
+        'e2e_p50_ms': 1000 * float(np.percentile(e2e, 50)),
+        'e2e_p99_ms': 1000 * float(np.percentile(e2e, 99)),
+        'cpu_percent': 100 * cpu / duration / os.cpu_count()
+    }
+
+def configurations(args):
+    ''' Yield every configuration of the sweep, naive runs only once '''
+    for resolution in args.resolutions:
+        for codec in args.codecs:
+            for strategy in args.strategies:
+                sequential = strategy == 'naive'
+                for consumers in [1] if sequential else args.consumers:
+                    for omp in args.omp:
+                        for queue_size in args.queuesize[:1] if sequential else args.queuesize:
+                            for load in args.loads:
+                                for batch in [1] if sequential else args.batch:
+                                    yield {
+                                        'resolution': '{0}x{1}'.format(*resolution),
+                                        'codec': codec,
+                                        'strategy': strategy,
+                                        'consumers': consumers,
+                                        'omp': omp,
+                                        'queue_size': queue_size,
+                                        'load': load,
+                                        'batch': batch
+                                    }
+
+def summarize(records):
+    ''' Median of the measurements over repeats, by configuration '''
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(record[k] for k in KEY), []).append(record)
+    summary = []
+    for key, group in groups.items():
+        row = dict(zip(KEY, key))
+        row['repeats'] = len(group)
+        for field in ['fps', 'latency_p50_ms', 'latency_p99_ms',
+                        'interval_p99_ms', 'e2e_p99_ms', 'cpu_percent']:
+            row[field] = float(np.median([r[field] for r in group]))
+        summary.append(row)
+    return summary
+
+def compare(summary, baseline, tolerance):
+    ''' Return the configurations whose FPS dropped by more than tolerance '''
+    reference = {tuple(row[k] for k in KEY): row for row in baseline}
+    regressions = []
+    for row in summary:
+        key = tuple(row[k] for k in KEY)
+        if key not in reference:
+            continue
+        ratio = row['fps'] / reference[key]['fps']
+        if ratio < 1 - tolerance:
+            regressions.append((row, reference[key]['fps'], ratio))
+    return regressions
+
+def int_list(text):
+    return [int(x) for x in text.split(',')]
+
+def str_list(text):
+    return text.split(',')
+
+def resolution_list(text):
+    return [tuple(int(x) for x in r.split('x')) for r in text.split(',')]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark video reading strategies on synthetic videos'
+    )
+    parser.add_argument('--resolutions', type=resolution_list, default='320x240,1280x720')
+    parser.add_argument('--codecs', type=str_list, default='mp4v,MJPG')
+    parser.add_argument('--frames', type=int, default=300, help='frames per video')
+    parser.add_argument('--strategies', type=str_list, default='naive,queue,shmqueue,shm,threads', help='naive or a transport of VideoReader.process, e.g. lockfree')
+    parser.add_argument('--consumers', '-n', type=int_list, default='1,2,4')
+    parser.add_argument('--omp', type=int_list, help='BLAS threads per process, needs threadpoolctl (default: 1)')
+    parser.add_argument('--queuesize', '-q', type=int_list, default='64')
+    parser.add_argument('--loads', type=str_list, default='N,MC', help='N, L, SC, MC')
+    parser.add_argument('--batch', '-b', type=int_list, default='1')
+    parser.add_argument('--repeats', '-r', type=int, default=3)
+    parser.add_argument('--videos', type=str, default='bench_videos', help='directory of generated videos')
+    parser.add_argument('--json', type=str, default='benchmark.json')
+    parser.add_argument('--csv', type=str, default='benchmark.csv')
+    parser.add_argument('--baseline', type=str, help='JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative FPS drop')
+    args = parser.parse_args()
+    if args.omp is None:
+        args.omp = [1] if has_threadpoolctl() else [0]
+    elif not has_threadpoolctl():
+        parser.error('--omp needs threadpoolctl, BLAS threads cannot be limited in running processes without it')
+
+    records = []
+    for config in configurations(args):
+        codec = config['codec']
+        resolution = tuple(int(x) for x in config['resolution'].split('x'))
+        videofile = test_video(args.videos, resolution, codec, args.frames)
+        for repeat in range(args.repeats):
+            record = dict(config)
+            record['repeat'] = repeat
+            record.update(run(videofile, config))
+            records.append(record)
+            print(' '.join('{0}={1}'.format(k, config[k]) for k in KEY) +
+                ' : {0:.1f} fps, p99 {1:.2f} ms, cpu {2:.0f}%'.format(
+                record['fps'],
+                record['latency_p99_ms'],
+                record['cpu_percent']
                 )
-                stop = time.time()
-                duration = stop-start
-                print('OMP_NUM_THREADS=' + str(omp) + ' ./producer_consumer.py ../jumanji_short.mp4 -n ' + str(n_consumers) + ' --gpu : ' + str(duration))
-            else:
-                subprocess.run(
-                    ['./producer_consumer.py', 
-                    '../jumanji_short.mp4',
-                    '-n ' + str(n_consumers)],
-                    env=my_env,
-                    capture_output=True
+            )
+
+    summary = summarize(records)
+    with open(args.json, 'w') as f:
+        json.dump({'runs': records, 'summary': summary}, f, indent=1)
+    with open(args.csv, 'w', newline='') as f:
+        # header written even when the sweep is empty
+        writer = csv.DictWriter(f, fieldnames=KEY + ['repeat'] + MEASURED)
+        writer.writeheader()
+        writer.writerows(records)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['summary']
+        regressions = compare(summary, baseline, args.tolerance)
+        for row, fps, ratio in regressions:
+            print('REGRESSION ' + ' '.join('{0}={1}'.format(k, row[k]) for k in KEY) +
+                ' : {0:.1f} fps vs {1:.1f} ({2:+.0f}%)'.format(
+                row['fps'], fps, 100*(ratio-1)
                 )
-                stop = time.time()
-                duration = stop-start
-                print('OMP_NUM_THREADS=' + str(omp) + './producer_consumer.py ../jumanji_short.mp4 -n ' + str(n_consumers) + ' : ' + str(duration))
+            )
+        if regressions:
+            sys.exit(1)
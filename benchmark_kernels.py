@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import cv2
+import kernels
+
+### Microbenchmark of each processing kernel against the straightforward
+### numpy version of the same computation, on synthetic grayscale frames.
+### Reports time per frame and the peak memory allocated by numpy during
+### one call (traced with tracemalloc, OpenCV's own allocations are not
+### visible), which should be far below a frame for the kernels.
+
+def synthetic_frames(n, height, width, seed=0):
+    ''' Noisy background with bright squares moving across the frames '''
+    rng = np.random.default_rng(seed)
+    background = rng.integers(20, 60, (height, width), dtype=np.uint8)
+    frames = np.empty((n, height, width), np.uint8)
+    size = max(height // 20, 2)
+    for i in range(n):
+        frames[i] = background
+        for j in range(8):
+            y = (j*height//8 + 3*i) % (height - size)
+            x = (j*width//8 + 5*i) % (width - size)
+            frames[i, y:y+size, x:x+size] = 200
+    return frames
+
+def numpy_background(alpha=0.01, threshold=25):
+    state = {}
+    def fn(frame, frame_num):
+        if 'background' not in state:
+            state['background'] = frame.astype(np.float32)
+        background = state['background']
+        foreground = np.abs(frame.astype(np.float32) - background) > threshold
+        state['background'] = (1 - alpha)*background + alpha*frame
+        return foreground.sum()
+    return fn
+
+def numpy_blobs(threshold=128):
+    def fn(frame, frame_num):
+        mask = (frame > threshold).astype(np.uint8)
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
+        order = np.argsort(-stats[1:, cv2.CC_STAT_AREA])
+        return stats[1:][order], centroids[1:][order]
+    return fn
+
+def numpy_profile(axis=0, binning=4):
+    def fn(frame, frame_num):
+        line = frame.astype(np.float32).mean(axis=axis)
+        size = len(line) // binning
+        return line[:size*binning].reshape(size, binning).mean(axis=1)
+    return fn
+
+def numpy_difference(threshold=25):
+    def fn(frames, frame_num):
+        diff = np.abs(frames[-1].astype(np.int16) - frames[-2])
+        return diff.mean(), (diff > threshold).sum()
+    return fn
+
+def run(fn, frames, windows, repeat):
+    ''' Return (seconds per frame, peak bytes allocated in one call) '''
+
+    def item(i):
+        if windows:
+            # previous and current frame
+            i = 1 + i % (len(frames) - 1)
+            return frames[i-1:i+1], i
+        i = i % len(frames)
+        return frames[i], i
+
+    # first calls allocate the kernel buffers
+    for i in range(2):
+        fn(*item(i))
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(*item(i))
+    duration = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    peak = 0
+    for i in range(4):
+        args = item(i)
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        fn(*args)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    return duration, peak
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Time per frame and allocations of the processing kernels'
+    )
+    parser.add_argument(
+        '--resolution',
+        type=str,
+        default='640x480,1920x1080,3840x2160',
+        help='comma separated WIDTHxHEIGHT'
+    )
+    parser.add_argument('--frames', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=1,
+        help='OpenCV threads, 1 as in a consumer process'
+    )
+    args = parser.parse_args()
+
+    cv2.setNumThreads(args.threads)
+
+    for resolution in args.resolution.split(','):
+        width, height = [int(x) for x in resolution.split('x')]
+        frames = synthetic_frames(args.frames, height, width)
+        repeat = max(args.repeat * 640*480 // (width*height), 10)
+        benchmarks = [
+            ('background', kernels.BackgroundSubtraction(), numpy_background(), False),
+            ('blobs', kernels.BlobStatistics(), numpy_blobs(), False),
+            ('profile', kernels.IntensityProfile((height, width)), numpy_profile(), False),
+            ('difference', kernels.FrameDifference(), numpy_difference(), True),
+        ]
+        print("{0}x{1}, frame {2:.1f} MB".format(width, height, width*height/2**20))
+        for name, kernel, baseline, windows in benchmarks:
+            t_kernel, mem_kernel = run(kernel, frames, windows, repeat)
+            t_numpy, mem_numpy = run(baseline, frames, windows, repeat)
+            print("  {0:10s} kernel {1:8.1f}us {2:8.0f} fps {3:10d} B | numpy {4:8.1f}us {5:8.0f} fps {6:10d} B | x{7:.1f}".format(
+                name,
+                1e6*t_kernel,
+                1/t_kernel,
+                mem_kernel,
+                1e6*t_numpy,
+                1/t_numpy,
+                mem_numpy,
+                t_numpy/t_kernel
+                )
+            )
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+from multiprocessing import Process
+from multiprocessing.sharedctypes import RawArray
+import time
+import argparse
+import numpy as np
+from shared_buffer import SharedRingBuffer
+from lockfree_buffer import LockFreeRingBuffer
+
+### Compare the event-driven SharedRingBuffer against the previous
+### implementation that released the lock and slept between checks, and
+### against the lock-free single producer ring
+
+class PollingRingBuffer(SharedRingBuffer):
+    ''' SharedRingBuffer waiting with time.sleep, kept for comparison '''
+
+    def full(self):
+        return self.write_cursor.value == (
+            (self.read_cursor.value - 1) % self.maxNumItems
+            )
+
+    def empty(self):
+        return self.write_cursor.value == self.read_cursor.value
+
+    def push(self, item, block=False, timeout=0.1):
+        self.wLock.acquire()
+        if block:
+            while self.full():
+                self.wLock.release()
+                time.sleep(timeout)
+                self.wLock.acquire()
+        else:
+            tStart = tNow = time.monotonic()
+            while tNow-tStart < timeout and self.full():
+                self.wLock.release()
+                time.sleep(timeout)
+                tNow = time.monotonic()
+                self.wLock.acquire()
+            if tNow-tStart >= timeout:
+                self.wLock.release()
+                return False
+
+        index = self.write_cursor.value
+        self.slots()[index] = item
+        self.write_cursor.value = (index + 1) % self.maxNumItems
+        self.wLock.release()
+        return True
+
+    def pop(self, block=False, timeout=0.1):
+        self.rLock.acquire()
+        if block:
+            while self.empty():
+                self.rLock.release()
+                time.sleep(timeout)
+                self.rLock.acquire()
+        else:
+            tStart = tNow = time.monotonic()
+            while self.empty() and tNow-tStart < timeout:
+                self.rLock.release()
+                time.sleep(timeout)
+                tNow = time.monotonic()
+                self.rLock.acquire()
+            if tNow-tStart >= timeout:
+                self.rLock.release()
+                return (False, [])
+
+        index = self.read_cursor.value
+        item = self.slots()[index].copy()
+        self.read_cursor.value = (index + 1) % self.maxNumItems
+        self.rLock.release()
+        return True, item
+
+STOP = -1.0
+
+def producer(buffer, n_items, item_size, interval, n_consumers):
+    """push timestamped items, optionally paced"""
+
+    item = np.zeros(item_size, dtype=np.uint8)
+    stamp = item[0:8].view(np.float64)
+    for i in range(n_items):
+        if interval > 0:
+            time.sleep(interval)
+        stamp[0] = time.perf_counter()
+        buffer.push(item, block=True, timeout=0.00001)
+
+    stamp[0] = STOP
+    for i in range(n_consumers):
+        buffer.push(item, block=True, timeout=0.00001)
+
+def consumer(buffer, latency, count, cpu, process_num, poll):
+    """pop items and record the producer to consumer handoff latency"""
+
+    cpu_start = time.process_time()
+    n = 0
+    while True:
+        if poll:
+            # what the consumers used to do
+            ok, item = buffer.pop(block=False, timeout=0.00001)
+        else:
+            ok, item = buffer.pop(block=True)
+        if not ok:
+            continue
+        now = time.perf_counter()
+        sent = item[0:8].view(np.float64)[0]
+        if sent == STOP:
+            break
+        # each consumer writes in its own stripe of the latency array
+        latency[process_num*len(latency)//len(count) + n] = now - sent
+        n += 1
+    count[process_num] = n
+    cpu[process_num] = time.process_time() - cpu_start
+
+def run(buffer_class, poll, n_items, item_size, n_consumers, qsize, interval):
+    """run one configuration and return (throughput, latencies, cpu time)"""
+
+    buffer = buffer_class(qsize, item_size)
+    latency = RawArray('d', n_items * n_consumers)
+    count = RawArray('i', n_consumers)
+    cpu = RawArray('d', n_consumers)
+
+    consumers = [
+        Process(
+            target=consumer,
+            args=(buffer, latency, count, cpu, i, poll)
+        )
+        for i in range(n_consumers)
+    ]
+    for p in consumers:
+        p.start()
+
+    start = time.perf_counter()
+    prod = Process(
+        target=producer,
+        args=(buffer, n_items, item_size, interval, n_consumers)
+    )
+    prod.start()
+    prod.join()
+    for p in consumers:
+        p.join()
+    duration = time.perf_counter() - start
+
+    lat = np.frombuffer(latency, dtype=np.float64).reshape(n_consumers, -1)
+    lat = np.concatenate([lat[i,:count[i]] for i in range(n_consumers)])
+    return n_items/duration, lat, sum(cpu)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Latency/throughput of SharedRingBuffer wait strategies'
+    )
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--itemsize', type=int, default=640*480)
+    parser.add_argument('-n', type=int, default=4, help='number of consumers')
+    parser.add_argument('--queuesize', '-q', type=int, default=64)
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=0.001,
+        help='pause between pushes for the paced (latency) run'
+    )
+    args = parser.parse_args()
+
+    configs = [
+        ('polling', PollingRingBuffer, True),
+        ('event', SharedRingBuffer, False),
+        ('lockfree', LockFreeRingBuffer, False),
+    ]
+    for interval in [0, args.interval]:
+        for name, buffer_class, poll in configs:
+            fps, lat, cpu = run(
+                buffer_class,
+                poll,
+                args.items,
+                args.itemsize,
+                args.n,
+                args.queuesize,
+                interval
+            )
+            print("{0:8s} interval {1}: {2:.0f} items/s, latency p50 {3:.1f}us p99 {4:.1f}us, consumer CPU {5:.2f}s".format(
+                name,
+                interval,
+                fps,
+                1e6*np.percentile(lat, 50),
+                1e6*np.percentile(lat, 99),
+                cpu
+                )
+            )
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+### Decoded frames cached on disk. A video is decoded (and converted to
+### grayscale) once, frames are written to a raw file next to a json index
+### (shape, dtype, frame count, pts). Later runs memory-map the raw file:
+### the 'cache' backend replays it through the usual producers, or workers
+### map it directly and need no producer at all (transport 'mmap').
+###
+### Entries are keyed by a hash of the video content, its size and mtime,
+### and of everything that changes the cached frames: color, the decoding
+### backend and its options (luma, every, keyframes_only, preprocessing...).
+### Options that only change how fast frames are decoded (decoder threads)
+### are left out, they share the entry. The cache directory is kept under a size
+### budget by evicting the least recently used entries.
+
+DEFAULT_DIRECTORY = os.environ.get(
+    'VIDEOREADER_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'videoreader')
+)
+DEFAULT_BUDGET = 20 * 2**30
+
+# bytes hashed at the beginning and at the end of the video, hashing a
+# whole 4K video would cost as much as decoding it
+HASH_BLOCK = 2**20
+
+def file_key(videofile):
+    ''' Hash of size, mtime and the first and last MiB of a file '''
+    stat = os.stat(videofile)
+    h = hashlib.sha1()
+    h.update(str((stat.st_size, stat.st_mtime_ns)).encode())
+    with open(videofile, 'rb') as f:
+        h.update(f.read(HASH_BLOCK))
+        if stat.st_size > HASH_BLOCK:
+            f.seek(max(HASH_BLOCK, stat.st_size - HASH_BLOCK))
+            h.update(f.read(HASH_BLOCK))
+    return h.hexdigest()
+
+class FrameCache:
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, budget=DEFAULT_BUDGET):
+        ''' budget: maximum size of the cache directory in bytes '''
+        self.directory = directory
+        self.budget = budget
+
+    def key(self, videofile, color=False, backend='cpu', **options):
+        if color:
+            params = 'color'
+        else:
+            # luma planes and converted gray frames have different values
+            params = 'luma' if _luma(backend, options) else 'gray'
+        return file_key(videofile) + '_' + params + '_' + decode_key(
+            color, backend, options)
+
+    def paths(self, key):
+        ''' Return (raw frames, json index) paths of an entry '''
+        base = os.path.join(self.directory, key)
+        return base + '.raw', base + '.json'
+
+    def lookup(self, videofile, color=False, backend='cpu', **options):
+        ''' Return the index of a complete entry, or None '''
+        raw, index = self.paths(self.key(videofile, color, backend, **options))
+        if not (os.path.exists(raw) and os.path.exists(index)):
+            return None
+        with open(index) as f:
+            entry = json.load(f)
+        # LRU: the index mtime is the last use
+        os.utime(index)
+        return entry
+
+    def open(self, videofile, color=False, backend='cpu', **options):
+        ''' Return a read-only (num_frames, ...) memmap of the frames, or None '''
+        entry = self.lookup(videofile, color, backend, **options)
+        if entry is None:
+            return None
+        return open_frames(entry)
+
+    def get(self, videofile, color=False, backend='cpu', verbose=False, **options):
+        ''' Return the index of an entry, decoding the video on a miss '''
+        entry = self.lookup(videofile, color, backend, **options)
+        if entry is None:
+            entry = self.build(videofile, color, backend, verbose, **options)
+        return entry
+
+    def build(self, videofile, color=False, backend='cpu', verbose=False, **options):
+        ''' Decode a video with backend and store its frames '''
+
+        # imported here, backends imports this module for the cache backend
+        import backends
+
+        key = self.key(videofile, color, backend, **options)
+        raw, index = self.paths(key)
+        os.makedirs(self.directory, exist_ok=True)
+
+        source = backends.open_source(videofile, backend, color, **options)
+        frame_size = int(np.prod(source.shape)) * source.dtype.itemsize
+        self.evict(source.num_frames * frame_size, keep=key)
+
+        # written under temporary names and renamed when complete, so that
+        # readers never see a partial entry
+        tmp = raw + '.{0}.tmp'.format(os.getpid())
+        tStt = time.time()
+        pts = []
+        frame = np.empty(source.shape, source.dtype)
+        with open(tmp, 'wb') as f:
+            while True:
+                rval, frame, frame_pts = source.read(frame)
+                if not rval:
+                    break
+                f.write(frame.tobytes())
+                pts.append(frame_pts)
+        source.release()
+
+        entry = {
+            'key': key,
+            'raw': raw,
+            'videofile': os.path.abspath(videofile),
+            'color': color,
+            'shape': list(source.shape),
+            'dtype': source.dtype.str,
+            'num_frames': len(pts),
+            # nan is not valid json
+            'pts': [None if np.isnan(p) else p for p in pts]
+        }
+        os.replace(tmp, raw)
+        with open(index + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(index + '.tmp', index)
+        if verbose:
+            print("Cached {0} frames of {1} in {2}s".format(
+                len(pts), videofile, time.time()-tStt
+                )
+            )
+        self.evict(0, keep=key)
+        return entry
+
+    def entries(self):
+        ''' Return [(last_used, size, key)] of the complete entries '''
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            raw, index = self.paths(key)
+            if os.path.exists(raw):
+                entries.append(
+                    (os.stat(index).st_mtime, os.stat(raw).st_size, key)
+                )
+        return entries
+
+    def size(self):
+        return sum(size for last_used, size, key in self.entries())
+
+    def evict(self, needed, keep=None):
+        ''' Remove least recently used entries until needed bytes fit '''
+        entries = sorted(self.entries())
+        total = sum(size for last_used, size, key in entries)
+        for last_used, size, key in entries:
+            if total + needed <= self.budget:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+
+    def remove(self, key):
+        for path in self.paths(key):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _luma(backend, options):
+    # the pyav backend delivers the luma plane unless told otherwise
+    return bool(options.get('luma', backend == 'pyav'))
+
+# backend options that do not change the decoded frames
+SPEED_OPTIONS = ('threads', 'thread_type')
+
+def _canonical(value):
+    # json representation that is the same in every run
+    if isinstance(value, np.dtype):
+        return value.str
+    if isinstance(value, (tuple, list)):
+        return [_canonical(v) for v in value]
+    if hasattr(value, '__dict__'):
+        # preprocessing.Preprocess and the like, by their parameters
+        return [type(value).__name__, _canonical(sorted(vars(value).items()))]
+    if isinstance(value, (type(None), bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    raise ValueError(
+        'cannot cache frames decoded with option {0!r}'.format(value))
+
+def decode_key(color, backend, options):
+    ''' Hash of the backend and the options that change the decoded frames '''
+    options = {
+        name: value for name, value in options.items()
+        if name not in SPEED_OPTIONS
+    }
+    options['luma'] = _luma(backend, options)
+    description = json.dumps(
+        [backend, bool(color), _canonical(sorted(options.items()))]
+    )
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+def open_frames(entry, mode='r'):
+    ''' Map the frames of a cache entry as a (num_frames, ...) array '''
+    return np.memmap(
+        entry['raw'],
+        dtype=np.dtype(entry['dtype']),
+        mode=mode,
+        shape=(entry['num_frames'],) + tuple(entry['shape'])
+    )
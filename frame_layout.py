@@ -0,0 +1,58 @@
+import numpy as np
+
+### Layout of a frame slot in shared memory. Each slot is one record of a
+### numpy structured dtype: a fixed header followed by the frame payload.
+
+HEADER_DTYPE = np.dtype(
+    [
+        ('index', np.uint64),       # frame number, starts at 1
+        ('pts', np.float64),        # presentation timestamp (ms), nan if unknown
+        ('decode_ts', np.float64),  # time.monotonic() when the frame was decoded
+        ('ndim', np.uint8),         # number of valid entries in shape
+        ('shape', np.uint32, 3),
+        ('dtype', 'S8'),            # numpy dtype string of the payload, e.g. '|u1'
+    ],
+    align = True
+)
+
+def frame_dtype(shape, dtype=np.uint8):
+    ''' Return the slot dtype for frames of a given shape and dtype '''
+    return np.dtype([('header', HEADER_DTYPE), ('frame', dtype, tuple(shape))])
+
+def batch_dtype(shape, dtype=np.uint8, batch_size=1):
+    '''
+    Return the slot dtype for batches of up to batch_size consecutive frames,
+    stored contiguously as a (batch_size,) + shape block
+    '''
+    return np.dtype(
+        [
+            ('count', np.uint32),   # number of valid frames in the batch
+            ('header', HEADER_DTYPE, (batch_size,)),
+            ('frame', dtype, (batch_size,) + tuple(shape)),
+        ]
+    )
+
+def fill_header(header, frame, index, pts, decode_ts):
+    ''' Fill one frame header, shape and dtype come from the frame '''
+    header['index'] = index
+    header['pts'] = pts
+    header['decode_ts'] = decode_ts
+    header['ndim'] = frame.ndim
+    header['shape'][:] = 0
+    header['shape'][:frame.ndim] = frame.shape
+    header['dtype'] = frame.dtype.str
+
+def write_header(slot, index, pts, decode_ts):
+    ''' Fill the header of a frame_dtype slot '''
+    fill_header(slot['header'], slot['frame'], index, pts, decode_ts)
+
+def frame_shape(header):
+    ''' Return the frame shape stored in a header '''
+    return tuple(int(x) for x in header['shape'][:header['ndim']])
+
+def packed(block, shape):
+    '''
+    Return a contiguous view of the first prod(shape) elements of a frame
+    block, for frames smaller than the slot they are stored in
+    '''
+    return block.reshape(-1)[:int(np.prod(shape))].reshape(shape)
@@ -0,0 +1,102 @@
+import queue
+import numpy as np
+
+### In-process counterpart of SharedRingBuffer for producer and consumer
+### threads. Slots are records of a preallocated numpy array, only slot
+### indices go through the queues: decoders write frames in place and
+### workers process them in place, frames are never copied or pickled.
+### Worth it when the processing function releases the GIL (OpenCV, BLAS).
+
+_CLOSED = -1
+
+class FramePool:
+
+    def __init__(self, maxNumItems, dtype):
+        ''' Allocate maxNumItems slots of dtype '''
+        self.dtype = np.dtype(dtype)
+        self.maxNumItems = maxNumItems
+        self._slots = np.zeros(maxNumItems, dtype=self.dtype)
+        self.free_slots = queue.Queue()
+        for index in range(maxNumItems):
+            self.free_slots.put(index)
+        # indices of filled slots in commit order
+        self.filled_slots = queue.Queue()
+        self._closed = False
+
+    def slots(self):
+        ''' Return the (maxNumItems,) array of records '''
+        return self._slots
+
+    def full(self):
+        return self.free_slots.empty()
+
+    def empty(self):
+        return self.size() == 0
+
+    def close(self):
+        '''
+        Signal end of stream. Readers drain the remaining items, then
+        acquire_read_slot/pop return False instead of blocking.
+        '''
+        if not self._closed:
+            self._closed = True
+            self.filled_slots.put(_CLOSED)
+
+    def closed(self):
+        return self._closed
+
+    def acquire_write_slot(self, block=False, timeout=0.1):
+        '''
+        Reserve a free slot and return (ok, index, view).
+        Fill the view in place then call commit(index).
+        '''
+        try:
+            index = self.free_slots.get(True, None if block else timeout)
+        except queue.Empty:
+            return (False, -1, None)
+        return (True, index, self._slots[index])
+
+    def commit(self, index):
+        ''' Make a slot filled with acquire_write_slot visible to readers '''
+        self.filled_slots.put(index)
+
+    def acquire_read_slot(self, block=False, timeout=0.1):
+        '''
+        Lease the oldest filled slot and return (ok, index, view).
+        The view stays valid until release(index) is called.
+        '''
+        try:
+            index = self.filled_slots.get(True, None if block else timeout)
+        except queue.Empty:
+            return (False, -1, None)
+        if index == _CLOSED:
+            # pass the end of stream on to the next reader
+            self.filled_slots.put(_CLOSED)
+            return (False, -1, None)
+        return (True, index, self._slots[index])
+
+    def release(self, index):
+        ''' Give a slot leased with acquire_read_slot back to writers '''
+        self.free_slots.put(index)
+
+    def push(self, item, block=False, timeout=0.1):
+        ''' Add item at the back, return False if no slot became free '''
+        ok, index, slot = self.acquire_write_slot(block, timeout)
+        if not ok:
+            return False
+        self._slots[index] = item
+        self.commit(index)
+        return True
+
+    def pop(self, block=False, timeout=0.1):
+        ''' Return a copy of the item at the front '''
+        ok, index, slot = self.acquire_read_slot(block, timeout)
+        if not ok:
+            return (False, [])
+        item = slot.copy()
+        self.release(index)
+        return True, item
+
+    def size(self):
+        ''' Return number of items currently stored in the pool '''
+        return max(0, self.filled_slots.qsize() - int(self._closed))
@@ -0,0 +1,211 @@
+import numpy as np
+import cv2
+
+### Processing kernels for consumers, to use as process() functions instead
+### of the synthetic loads. They read grayscale uint8 frames where they are
+### (ring slots, pool frames) and write into buffers allocated on the first
+### frame, so that no frame-sized array is allocated afterwards: OpenCV
+### functions are given dst buffers, numpy is avoided where it would create
+### temporaries. Results are small and returned as new objects, queue
+### transports pickle them after the call returns.
+###
+### Kernels are copied to every worker process, state such as a background
+### model is therefore per worker and learns from the frames that worker
+### gets.
+
+class Kernel:
+
+    # dtype of one result, for process(result_dtype=...)
+    result_dtype = None
+
+    def allocate(self, shape):
+        ''' Allocate buffers for frames of this shape '''
+        pass
+
+    def apply(self, frame):
+        ''' Result for one frame '''
+        raise NotImplementedError
+
+    def __call__(self, frame, frame_num):
+        # batches come with an array of frame numbers, one result per frame
+        single = np.ndim(frame_num) == 0
+        shape = frame.shape if single else frame.shape[1:]
+        if getattr(self, '_shape', None) != shape:
+            self.allocate(shape)
+            self._shape = shape
+        if single:
+            return self.apply(frame)
+        results = np.empty(len(frame), self.result_dtype)
+        for i in range(len(frame)):
+            results[i] = self.apply(frame[i])
+        return results
+
+class BackgroundSubtraction(Kernel):
+
+    result_dtype = np.dtype(np.int64)
+
+    def __init__(self, alpha=0.01, threshold=25, background=None):
+        '''
+        Running average background, returns the number of foreground
+        pixels, the mask of the last frame is in self.mask.
+
+        alpha: weight of the new frame in the background
+        threshold: absolute difference for a pixel to be foreground
+        background: initial background (default: first frame), kept as is
+            with alpha=0
+        '''
+        self.alpha = alpha
+        self.threshold = threshold
+        self.initial = background
+
+    def allocate(self, shape):
+        self.background = np.empty(shape, np.float32)
+        self.background8 = np.empty(shape, np.uint8)
+        self.diff = np.empty(shape, np.uint8)
+        self.mask = np.empty(shape, np.uint8)
+        self._started = False
+        if self.initial is not None:
+            self.background[...] = self.initial
+            self._started = True
+
+    def apply(self, frame):
+        if not self._started:
+            self.background[...] = frame
+            self._started = True
+        # compare with the background before it learns this frame
+        cv2.convertScaleAbs(self.background, dst=self.background8)
+        cv2.absdiff(frame, self.background8, dst=self.diff)
+        cv2.threshold(self.diff, self.threshold, 255, cv2.THRESH_BINARY,
+                        dst=self.mask)
+        if self.alpha > 0:
+            cv2.accumulateWeighted(frame, self.background, self.alpha)
+        return cv2.countNonZero(self.mask)
+
+def blob_dtype(max_blobs):
+    ''' Result of BlobStatistics, blobs sorted by decreasing area '''
+    return np.dtype([
+        ('count', np.int32),
+        ('area', np.int32, (max_blobs,)),
+        ('centroid', np.float32, (max_blobs, 2)),   # x, y
+        ('bbox', np.int32, (max_blobs, 4))          # x, y, width, height
+    ])
+
+class BlobStatistics(Kernel):
+
+    def __init__(self, threshold=128, invert=False, min_area=1, max_blobs=16):
+        '''
+        Threshold the frame and describe its connected components.
+
+        invert: dark blobs on a bright background
+        min_area: smaller blobs (noise) are ignored
+        max_blobs: largest blobs reported, count is the number of blobs
+            found before this cut
+        '''
+        self.threshold = threshold
+        self.type = cv2.THRESH_BINARY_INV if invert else cv2.THRESH_BINARY
+        self.min_area = min_area
+        self.max_blobs = max_blobs
+        self.result_dtype = blob_dtype(max_blobs)
+
+    def allocate(self, shape):
+        self.mask = np.empty(shape, np.uint8)
+        self.labels = np.empty(shape, np.int32)
+
+    def apply(self, frame):
+        cv2.threshold(frame, self.threshold, 255, self.type, dst=self.mask)
+        # per blob arrays are allocated by OpenCV, they are small
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(
+            self.mask,
+            labels=self.labels,
+            connectivity=8,
+            ltype=cv2.CV_32S
+        )
+        # label 0 is the background
+        area = stats[1:, cv2.CC_STAT_AREA]
+        keep = np.flatnonzero(area >= self.min_area)
+        keep = keep[np.argsort(-area[keep], kind='stable')]
+
+        result = np.zeros((), self.result_dtype)
+        result['count'] = len(keep)
+        keep = keep[:self.max_blobs]
+        result['area'][:len(keep)] = area[keep]
+        result['centroid'][:len(keep)] = centroids[1:][keep]
+        result['bbox'][:len(keep)] = stats[1:, :4][keep]
+        return result
+
+class IntensityProfile(Kernel):
+
+    def __init__(self, shape, axis=0, binning=4):
+        '''
+        Mean intensity along rows or columns of frames of shape, binned by
+        binning pixels: axis=0 averages each column (profile along x),
+        axis=1 each row (profile along y)
+        '''
+        self.axis = axis
+        self.binning = binning
+        self.size = shape[1 - axis] // binning
+        self.result_dtype = np.dtype((np.float32, (self.size,)))
+
+    def allocate(self, shape):
+        # one float per row or column, then whole bins only
+        length = shape[1 - self.axis]
+        if length // self.binning != self.size:
+            # result_dtype was given to process() with the constructor shape
+            raise ValueError(
+                'IntensityProfile of {0} bins got frames of shape {1}'.format(
+                    self.size, shape
+                )
+            )
+        self.line = np.empty(
+            (1, length) if self.axis == 0 else (length, 1),
+            np.float32
+        )
+        self.profile = np.empty(self.size, np.float32)
+
+    def apply(self, frame):
+        # the frame is reduced in float once, binning works on one line
+        cv2.reduce(frame, self.axis, cv2.REDUCE_AVG, dst=self.line,
+                    dtype=cv2.CV_32F)
+        bins = self.line.ravel()[:self.size*self.binning].reshape(
+            self.size, self.binning
+        )
+        np.add.reduce(bins, axis=1, out=self.profile)
+        self.profile *= 1/self.binning
+        return self.profile.copy()
+
+class FrameDifference(Kernel):
+
+    result_dtype = np.dtype([('mean', np.float32), ('changed', np.int64)])
+
+    def __init__(self, threshold=25):
+        '''
+        Difference between a frame and the previous one, for
+        process(history=1): mean absolute difference and number of pixels
+        that changed by more than threshold. The first frame has no
+        previous frame, its result is zero.
+        '''
+        self.threshold = threshold
+
+    def allocate(self, shape):
+        self.diff = np.empty(shape, np.uint8)
+        self.mask = np.empty(shape, np.uint8)
+
+    def __call__(self, frames, frame_num):
+        # windows are shorter at the beginning, buffers follow the frame shape
+        if np.ndim(frame_num) != 0 or frames.ndim != 3:
+            raise ValueError('FrameDifference needs windows, use history=1')
+        if getattr(self, '_shape', None) != frames.shape[1:]:
+            self.allocate(frames.shape[1:])
+            self._shape = frames.shape[1:]
+        return self.apply(frames)
+
+    def apply(self, frames):
+        result = np.zeros((), self.result_dtype)
+        if len(frames) < 2:
+            return result
+        cv2.absdiff(frames[-1], frames[-2], dst=self.diff)
+        cv2.threshold(self.diff, self.threshold, 255, cv2.THRESH_BINARY,
+                        dst=self.mask)
+        result['mean'] = cv2.mean(self.diff)[0]
+        result['changed'] = cv2.countNonZero(self.mask)
+        return result
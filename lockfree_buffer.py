@@ -0,0 +1,312 @@
+from multiprocessing import Lock, Semaphore
+from multiprocessing.sharedctypes import RawArray, RawValue
+import ctypes
+import ctypes.util
+import time
+import numpy as np
+from ring_memory import RingMemory
+
+### Single producer / multiple consumers ring buffer. Consumers claim
+### positions with an atomic fetch-and-add on a shared 64-bit counter
+### instead of serializing on a lock. Each slot carries a sequence number
+### telling whether it is free for position p (seq == p) or holds the item
+### for position p (seq == p+1). Positions never wrap in practice (2^63).
+###
+### VideoReader.process(transport='lockfree') runs the shm loops on this
+### ring: same slot leases, a single producer, no history, supervision or
+### autoscaling.
+
+SEQ_CST = 5
+
+# a slot freed out of order is usually given back within microseconds:
+# the producer spins this many times, then sleeps with a growing delay
+SPIN = 100
+MAX_BACKOFF = 0.001
+
+_atomic_fetch_add = None
+_atomic_load = None
+_atomic_store = None
+if ctypes.util.find_library('atomic') is not None:
+    try:
+        _libatomic = ctypes.CDLL(ctypes.util.find_library('atomic'))
+        # looked up with getattr, double underscore names would be mangled
+        # inside class bodies
+        _atomic_fetch_add = getattr(_libatomic, '__atomic_fetch_add_8')
+        _atomic_fetch_add.restype = ctypes.c_int64
+        _atomic_fetch_add.argtypes = [
+            ctypes.c_void_p, ctypes.c_int64, ctypes.c_int
+        ]
+        _atomic_load = getattr(_libatomic, '__atomic_load_8')
+        _atomic_load.restype = ctypes.c_int64
+        _atomic_load.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        _atomic_store = getattr(_libatomic, '__atomic_store_8')
+        _atomic_store.restype = None
+        _atomic_store.argtypes = [
+            ctypes.c_void_p, ctypes.c_int64, ctypes.c_int
+        ]
+    except (OSError, AttributeError):
+        _atomic_fetch_add = _atomic_load = _atomic_store = None
+
+def has_atomics():
+    ''' True if hardware atomics from libatomic are available '''
+    return _atomic_fetch_add is not None
+
+class AtomicCounter:
+    ''' 64-bit integer in shared memory supporting fetch-and-add '''
+
+    def __init__(self, value=0):
+        self.counter = RawValue('q', value)
+        # only used when libatomic is missing
+        self.lock = Lock()
+        self._address = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_address'] = None
+        return state
+
+    def address(self):
+        if self._address is None:
+            self._address = ctypes.addressof(self.counter)
+        return self._address
+
+    def fetch_add(self, n=1):
+        if _atomic_fetch_add is not None:
+            return _atomic_fetch_add(self.address(), n, SEQ_CST)
+        with self.lock:
+            value = self.counter.value
+            self.counter.value = value + n
+        return value
+
+    def load(self):
+        if _atomic_fetch_add is not None:
+            return _atomic_load(self.address(), SEQ_CST)
+        return self.counter.value
+
+    def store(self, value):
+        if _atomic_fetch_add is not None:
+            _atomic_store(self.address(), value, SEQ_CST)
+        else:
+            self.counter.value = value
+
+class LockFreeRingBuffer:
+
+    def __init__(
+        self,
+        maxNumItems,
+        itemSize = 1,
+        buftype = 'B',
+        dtype = None,
+        huge_pages = None,
+        prefault = False
+    ):
+        '''
+        Allocate shared array and per-slot sequence numbers. huge_pages
+        and prefault: see ring_memory.RingMemory
+        '''
+
+        if maxNumItems < 2:
+            raise ValueError('LockFreeRingBuffer needs at least 2 slots')
+
+        # items can be described by a numpy (structured) dtype, slots are
+        # then records of that dtype
+        if dtype is not None:
+            dtype = np.dtype(dtype)
+            itemSize = dtype.itemsize
+            buftype = 'B'
+        self.dtype = dtype
+        self.maxNumItems = maxNumItems
+        self.itemSize = itemSize
+        self.totalSize = maxNumItems*itemSize
+        self.buftype = buftype
+        # pages are allocated on first touch, not zero-filled here
+        self.data = RingMemory(
+            maxNumItems*itemSize*np.dtype(buftype).itemsize,
+            huge_pages,
+            prefault
+        )
+        self.sequence = RawArray('q', range(maxNumItems))
+        # next position written by the producer
+        self.write_cursor = AtomicCounter(0)
+        # next position claimed by a consumer
+        self.read_cursor = AtomicCounter(0)
+        # semaphores are only used to sleep when there is nothing to do,
+        # their fast path is a single atomic operation
+        self.free_slots = Semaphore(maxNumItems)
+        self.filled_slots = Semaphore(0)
+        # end of stream is signaled out of band, not with a magic item
+        self.closed_flag = RawValue('b',0)
+        self._slots = None
+        self._sequence_address = None
+
+    def __getstate__(self):
+        # numpy views and addresses are rebuilt in each process
+        state = self.__dict__.copy()
+        state['_slots'] = None
+        state['_sequence_address'] = None
+        return state
+
+    def slots(self):
+        '''
+        Return a (maxNumItems, itemSize) numpy view of the shared array,
+        or a (maxNumItems,) array of records if the buffer has a dtype
+        '''
+        if self._slots is None and self.dtype is not None:
+            self._slots = np.frombuffer(
+                self.data.buf,
+                dtype=self.dtype,
+                count=self.maxNumItems
+            )
+        elif self._slots is None:
+            self._slots = np.frombuffer(
+                self.data.buf,
+                dtype=np.dtype(self.buftype),
+                count=self.totalSize
+            ).reshape(self.maxNumItems, self.itemSize)
+        return self._slots
+
+    def _load_sequence(self, slot):
+        if _atomic_fetch_add is None:
+            return self.sequence[slot]
+        if self._sequence_address is None:
+            self._sequence_address = ctypes.addressof(self.sequence)
+        return _atomic_load(
+            self._sequence_address + 8*slot,
+            SEQ_CST
+        )
+
+    def _store_sequence(self, slot, value):
+        if _atomic_fetch_add is None:
+            self.sequence[slot] = value
+            return
+        if self._sequence_address is None:
+            self._sequence_address = ctypes.addressof(self.sequence)
+        _atomic_store(
+            self._sequence_address + 8*slot,
+            value,
+            SEQ_CST
+        )
+
+    def ready(self, slot):
+        ''' True if slot holds an item that was pushed but not yet released '''
+        return (self._load_sequence(slot) - 1 - slot) % self.maxNumItems == 0
+
+    def full(self):
+        ''' True if the next slot to write is still in use '''
+        position = self.write_cursor.load()
+        slot = position % self.maxNumItems
+        return self._load_sequence(slot) != position
+
+    def empty(self):
+        return self.size() == 0
+
+    def size(self):
+        ''' Return number of items pushed but not yet claimed '''
+        return max(0, self.write_cursor.load() - self.read_cursor.load())
+
+    def close(self):
+        '''
+        Signal end of stream. Readers drain the remaining items, then
+        acquire_read_slot/pop return False instead of blocking.
+        '''
+        self.closed_flag.value = 1
+        # one extra permit wakes up a reader, which hands it over to the next
+        self.filled_slots.release()
+
+    def closed(self):
+        return self.closed_flag.value == 1
+
+    def check(self,item):
+        pass
+
+    def acquire_write_slot(self, block=False, timeout=0.1):
+        '''
+        Return (ok, position, view) for the next slot. Single producer only.
+        Fill the view in place then call commit(position).
+        '''
+
+        deadline = None if block else time.monotonic() + timeout
+        if not self.free_slots.acquire(True, None if block else timeout):
+            return (False, -1, None)
+
+        position = self.write_cursor.load()
+        slot = position % self.maxNumItems
+        # a permit can come from a consumer releasing a later slot first,
+        # wait for the consumer holding this slot to give it back
+        spins = 0
+        delay = 1e-5
+        while self._load_sequence(slot) != position:
+            if spins < SPIN:
+                spins += 1
+                continue
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # the permit stays with the ring for the next attempt
+                    self.free_slots.release()
+                    return (False, -1, None)
+                time.sleep(min(delay, remaining))
+            else:
+                time.sleep(delay)
+            delay = min(2*delay, MAX_BACKOFF)
+
+        return (True, position, self.slots()[slot])
+
+    def commit(self, position):
+        ''' Publish the slot filled after acquire_write_slot '''
+
+        self._store_sequence(position % self.maxNumItems, position + 1)
+        self.write_cursor.store(position + 1)
+        self.filled_slots.release()
+
+    def acquire_read_slot(self, block=False, timeout=0.1):
+        '''
+        Claim the next item and return (ok, position, view).
+        The view stays valid until release(position) is called.
+        '''
+
+        if not self.filled_slots.acquire(True, None if block else timeout):
+            return (False, -1, None)
+
+        # each permit matches a published item, so the claimed position
+        # is always ready. Positions past the last item are only claimed
+        # with the end of stream permit.
+        position = self.read_cursor.fetch_add(1)
+        if position >= self.write_cursor.load():
+            self.filled_slots.release()
+            return (False, -1, None)
+        return (True, position, self.slots()[position % self.maxNumItems])
+
+    def release(self, position):
+        ''' Mark the slot as free for the producer's next lap '''
+
+        self._store_sequence(
+            position % self.maxNumItems,
+            position + self.maxNumItems
+        )
+        self.free_slots.release()
+
+    def push(self, item, block=False, timeout=0.1):
+        ''' Add item at the back, return False if no slot became free '''
+
+        ok, position, slot = self.acquire_write_slot(block, timeout)
+        if not ok:
+            return False
+        self.slots()[position % self.maxNumItems] = item
+        self.commit(position)
+        return True
+
+    def pop(self, block=False, timeout=0.1):
+        ''' Return item from the front '''
+
+        ok, position, slot = self.acquire_read_slot(block, timeout)
+        if not ok:
+            return (False, [])
+
+        if self.dtype is None and self.itemSize == 1:
+            item = slot[0].item()
+        else:
+            item = slot.copy()
+        self.release(position)
+
+        return True, item
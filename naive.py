@@ -1,47 +1,20 @@
 #!/usr/bin/env python3
 
-import os
-import cv2
 import time
 import utils
 
 # parse arguments
-videofile, use_gpu, pfun, cvcuda, host, _, _ = utils.parse_arguments()
+args = utils.parse_arguments()
 
-# Hardware acceleration on NVIDIA GPU 
-if use_gpu:
-    if cvcuda:
-        cap = cv2.cudacodec.createVideoReader(videofile)
-    else:
-        os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"]="video_codec;h264_cuvid"
-        cap = cv2.VideoCapture(videofile, cv2.CAP_FFMPEG)
-else:
-    cap = cv2.VideoCapture(videofile, cv2.CAP_FFMPEG)
+# read and process frames sequentially in this process
+reader = utils.open_reader(args)
 
 frame_num = 0
 duration = 0
 start = time.time()
-while True:
-
-    # Get frames here
-    if use_gpu and cvcuda:
-        rval, frame = cap.nextFrame()
-        if rval:
-            frame_gray = cv2.cuda.cvtColor(frame,cv2.COLOR_RGBA2GRAY)
-            if host:
-                frame_gray = frame_gray.download()
-    else:
-        rval, frame = cap.read()
-        if rval:
-            frame_gray = cv2.cvtColor(frame,cv2.COLOR_RGB2GRAY) 
-    
-    if not rval:
-        break
-    
-    frame_num += 1
-    
+for frame_num, frame_gray in reader:
     try:
-        pfun(frame_gray,frame_num)
+        args.pfun(frame_gray,frame_num)
     except KeyboardInterrupt:
         break
 
@@ -49,6 +22,3 @@ stop = time.time()
 duration = stop - start
 fps = frame_num/duration
 print("num frames : " + str(frame_num) + ", duration : " + str(duration) + ", FPS : " + str(fps))
-
-if not cvcuda:
-    cap.release()
@@ -0,0 +1,213 @@
+from contextlib import contextmanager
+import glob
+import os
+import re
+from autoscale import set_blas_threads
+
+### Pin producers and consumers to disjoint sets of physical cores.
+###
+### The CPU topology is read from sysfs: logical cpus sharing a core_id (and
+### package) are hyperthreads of one physical core, and NUMA nodes list their
+### cpus. Producers get their own cores, the remaining cores are split
+### between consumers, and each consumer runs as many BLAS threads as it has
+### physical cores, so that BLAS threads and other processes do not fight
+### over the same cores. Everything is kept on one NUMA node when it fits,
+### and shared memory is allocated from that node: Linux places a page on
+### the node of the cpu that first touches it, so rings are created while
+### the main thread runs on the consumers' node.
+
+SYSFS = '/sys/devices/system'
+
+def parse_cpulist(text):
+    ''' '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11] '''
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def _read_int(path, default):
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return default
+
+def cpu_topology(sysfs=SYSFS, allowed=None):
+    '''
+    Return {node: [[logical cpus of a physical core], ...]} for the cpus
+    this process may run on, cores sorted by their first cpu
+    '''
+    if allowed is None:
+        allowed = os.sched_getaffinity(0)
+
+    node_of = {}
+    for path in glob.glob(os.path.join(sysfs, 'node', 'node*', 'cpulist')):
+        node = int(re.search(r'node(\d+)', path).group(1))
+        with open(path) as f:
+            for cpu in parse_cpulist(f.read()):
+                node_of[cpu] = node
+
+    cores = {}
+    for cpu in sorted(allowed):
+        topology = os.path.join(sysfs, 'cpu', 'cpu{0}'.format(cpu), 'topology')
+        package = _read_int(os.path.join(topology, 'physical_package_id'), 0)
+        # without topology every cpu is its own core
+        core = _read_int(os.path.join(topology, 'core_id'), cpu)
+        key = (node_of.get(cpu, 0), package, core)
+        cores.setdefault(key, []).append(cpu)
+
+    nodes = {}
+    for (node, package, core), cpus in sorted(cores.items(), key=lambda c: c[1][0]):
+        nodes.setdefault(node, []).append(cpus)
+    return nodes
+
+def _share(count, sizes):
+    ''' Split count in proportion to sizes, at most one per size unit '''
+    total = sum(sizes)
+    shares = [count*size // total for size in sizes]
+    # largest remainders get the rest
+    order = sorted(range(len(sizes)), key=lambda i: -(count*sizes[i] % total))
+    for i in order[:count - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+class Plan:
+
+    def __init__(self, producers, workers, threads, node, memory_cpus):
+        '''
+        producers, workers: cpu set of each process
+        threads: BLAS threads of each worker
+        node: NUMA node of the workers, where shared memory goes
+        memory_cpus: cpus of that node
+        '''
+        self.producers = producers
+        self.workers = workers
+        self.threads = threads
+        self.node = node
+        self.memory_cpus = memory_cpus
+
+    def __repr__(self):
+        return "Plan(producers={0}, workers={1}, threads={2}, node={3})".format(
+            [sorted(c) for c in self.producers],
+            [sorted(c) for c in self.workers],
+            self.threads,
+            self.node
+        )
+
+class Placement:
+
+    def __init__(self, producer_cores=1, node=None, threads='physical',
+                    sysfs=SYSFS):
+        '''
+        producer_cores: physical cores reserved for each producer, decoders
+            are multithreaded too
+        node: NUMA node to run on, None keeps everything on the largest
+            node when it has enough cores and uses all nodes otherwise
+        threads: BLAS threads per consumer, 'physical' (one per physical
+            core, hyperthreads rarely help BLAS), 'logical', or None to
+            leave them alone
+        '''
+        self.producer_cores = producer_cores
+        self.node = node
+        self.threads = threads
+        self.sysfs = sysfs
+
+    def plan(self, n_producers, n_workers, allowed=None):
+        ''' Return the Plan for n_producers and n_workers processes '''
+
+        nodes = cpu_topology(self.sysfs, allowed)
+        needed = n_producers*self.producer_cores + n_workers
+        if self.node is not None:
+            if self.node not in nodes:
+                raise ValueError('no usable cpu on node ' + str(self.node))
+            order = [self.node]
+        else:
+            # largest node first, the others only if it is too small
+            order = sorted(nodes, key=lambda n: -len(nodes[n]))
+            if len(nodes[order[0]]) >= needed:
+                order = order[:1]
+        cores = [core for node in order for core in nodes[node]]
+
+        # producers get their own cores if workers still get one each,
+        # otherwise they float over all of them
+        reserved = n_producers*self.producer_cores
+        if len(cores) - reserved < n_workers:
+            reserved = 0
+        producers = []
+        for i in range(n_producers):
+            taken = cores[i*self.producer_cores:(i+1)*self.producer_cores]
+            if not reserved:
+                taken = cores
+            producers.append(set(cpu for core in taken for cpu in core))
+        cores = cores[reserved:]
+
+        if len(cores) >= n_workers:
+            # workers never straddle nodes: split them between nodes in
+            # proportion to the cores left there, then split each node's
+            # cores evenly between its workers
+            per_node = [
+                [core for core in cores if core in nodes[node]] for node in order
+            ]
+            counts = _share(n_workers, [len(c) for c in per_node])
+            taken = []
+            for node_cores, count in zip(per_node, counts):
+                for i in range(count):
+                    size, extra = divmod(len(node_cores), count)
+                    first = i*size + min(i, extra)
+                    taken.append(node_cores[first:first + size + (i < extra)])
+        else:
+            # more workers than cores, they share
+            taken = [[cores[i % len(cores)]] for i in range(n_workers)]
+
+        workers = []
+        threads = []
+        for worker_cores in taken:
+            cpus = set(cpu for core in worker_cores for cpu in core)
+            workers.append(cpus)
+            if self.threads == 'physical':
+                threads.append(len(worker_cores))
+            elif self.threads == 'logical':
+                threads.append(len(cpus))
+            else:
+                threads.append(None)
+
+        # memory goes where most worker cores are
+        node = max(order, key=lambda n: sum(
+            len(cpus & set(cpu for core in nodes[n] for cpu in core))
+            for cpus in workers
+        ))
+        memory_cpus = set(cpu for core in nodes[node] for cpu in core)
+        return Plan(producers, workers, threads, node, memory_cpus)
+
+@contextmanager
+def memory_on(plan):
+    '''
+    Run the calling thread on the workers' node, shared memory first
+    touched in the block (zeroed or prefaulted) lands on that node
+    '''
+    if plan is None:
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, plan.memory_cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+def run_pinned(cpus, threads, target, args):
+    '''
+    Process target: move to cpus and set the BLAS threads before running
+    target(*args). Done in the child so that replacement workers are pinned
+    too, whatever the start method.
+    '''
+    os.sched_setaffinity(0, cpus)
+    if threads:
+        set_blas_threads(threads)
+    target(*args)
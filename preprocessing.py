@@ -0,0 +1,163 @@
+import numpy as np
+
+### Preprocessing done once by the producer instead of in every consumer.
+### Frames are cropped first (a view, free), then converted, resized and
+### cast, so that only the region of interest is ever converted and the
+### last step writes straight into the shared slot. Smaller frames also
+### mean fewer bytes through the transport.
+
+class Preprocess:
+
+    def __init__(
+        self,
+        roi = None,
+        size = None,
+        binning = 1,
+        channel = None,
+        dtype = None,
+        normalize = False
+    ):
+        '''
+        roi: (x, y, width, height) region of interest
+        size: (width, height) to resize the region to
+        binning: average binning x binning pixel blocks, alternative to size
+        channel: 'gray', 'bgr', 'rgb' or the index of a BGR channel. None
+            keeps the reader's choice (grayscale unless color)
+        dtype: output dtype, e.g. np.float32
+        normalize: scale 8-bit values to [0, 1], requires a float dtype
+        '''
+        if size is not None and binning != 1:
+            raise ValueError('use either size or binning')
+        if normalize and (dtype is None or np.dtype(dtype).kind != 'f'):
+            raise ValueError('normalize requires a float dtype')
+        if roi is not None:
+            if len(roi) != 4:
+                raise ValueError('roi must be (x, y, width, height)')
+            x, y, w, h = roi
+            if x < 0 or y < 0 or w <= 0 or h <= 0:
+                raise ValueError('roi {0} is empty or starts outside the frame'.format(roi))
+        self.roi = roi
+        self.size = size
+        self.binning = binning
+        self.channel = channel
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.normalize = normalize
+
+    def channels(self, color):
+        ''' Resolve channel with the reader color flag '''
+        if self.channel is None:
+            return 'bgr' if color else 'gray'
+        return self.channel
+
+    def crop(self, height, width):
+        '''
+        Return the (y, x, height, width) actually cropped from frames of
+        this size, raise ValueError if the roi does not fit in them
+        '''
+        if self.roi is None:
+            x, y, w, h = 0, 0, width, height
+        else:
+            x, y, w, h = self.roi
+            if x + w > width or y + h > height:
+                raise ValueError('roi {0} is outside the {1}x{2} frames'.format(
+                    self.roi, width, height))
+        if self.binning > 1:
+            # whole bins only
+            w -= w % self.binning
+            h -= h % self.binning
+            if w == 0 or h == 0:
+                raise ValueError('the region is smaller than one bin')
+        return y, x, h, w
+
+    def output_size(self, height, width):
+        ''' Return (height, width) after crop and resize '''
+        y, x, h, w = self.crop(height, width)
+        if self.size is not None:
+            return self.size[1], self.size[0]
+        return h // self.binning, w // self.binning
+
+class PreprocessedSource:
+
+    def __init__(self, source, preprocess, color=False):
+        '''
+        Wrap a color frame source, frames are preprocessed in read. Exposes
+        the same interface as the sources in backends.py
+        '''
+
+        import cv2
+        self._cv2 = cv2
+
+        self.source = source
+        self.preprocess = preprocess
+        self.channel = preprocess.channels(color)
+        self.num_frames = source.num_frames
+
+        height, width = source.shape[:2]
+        self.crop = preprocess.crop(height, width)
+        out_height, out_width = preprocess.output_size(height, width)
+        self.resize = (out_height, out_width) != self.crop[2:]
+        if self.channel in ('bgr', 'rgb'):
+            self.shape = (out_height, out_width, 3)
+        else:
+            self.shape = (out_height, out_width)
+        self.dtype = preprocess.dtype or source.dtype
+
+        # intermediate buffers, allocated once
+        self._frame = np.empty(source.shape, source.dtype)
+        if self.channel in ('bgr', 'rgb'):
+            self._converted = np.empty(self.crop[2:] + (3,), source.dtype)
+        else:
+            self._converted = np.empty(self.crop[2:], source.dtype)
+        self._resized = np.empty(self.shape, source.dtype)
+
+    @property
+    def decode_ts(self):
+        return self.source.decode_ts
+
+    def read(self, out=None):
+        cv2 = self._cv2
+        rval, frame, pts = self.source.read(self._frame)
+        if not rval:
+            return False, None, np.nan
+        if out is None:
+            out = np.empty(self.shape, self.dtype)
+
+        y, x, h, w = self.crop
+        frame = frame[y:y+h, x:x+w]
+
+        last = not self.resize and self.preprocess.dtype is None
+        if self.channel == 'gray':
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY,
+                                    dst=self._buffer('_converted', out, last))
+        elif self.channel == 'rgb':
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB,
+                                    dst=self._buffer('_converted', out, last))
+        elif self.channel != 'bgr':
+            frame = frame[:, :, self.channel]
+
+        if self.resize:
+            last = self.preprocess.dtype is None
+            frame = cv2.resize(
+                frame,
+                (self.shape[1], self.shape[0]),
+                dst=self._buffer('_resized', out, last),
+                interpolation=cv2.INTER_AREA
+            )
+
+        if self.preprocess.normalize:
+            np.multiply(frame, self.dtype.type(1/255), out=out)
+        elif frame is not out:
+            out[...] = frame
+        return True, out, pts
+
+    def _buffer(self, name, out, last):
+        # the last step writes into the output directly
+        if last:
+            return out
+        return getattr(self, name)
+
+    def seek(self, frame_index):
+        self.source.seek(frame_index)
+
+    def release(self):
+        self.source.release()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import utils
+from video_batch import VideoBatch
+
+### Process a list of videos with one persistent pool of producers and
+### consumers instead of starting the pipeline again for every file
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Process many videos with a persistent producer-consumer pipeline'
+    )
+    parser.add_argument('videos', type=str, nargs='+', help='Video files or glob patterns')
+    parser.add_argument('--load', type=str, default='MC', help='Synthetic load: N, L, SC, MC')
+    parser.add_argument('-n', type=int, default=1, help='number of consumer processes')
+    parser.add_argument('-p', '--producers', type=int, default=2, help='number of videos decoded at the same time')
+    parser.add_argument('-q', '--queuesize', type=int, default=256)
+    parser.add_argument('-b', '--batch', type=int, default=1)
+    parser.add_argument('--color', action='store_true')
+    args = parser.parse_args()
+
+    videos = []
+    for pattern in args.videos:
+        # the shell does not expand quoted patterns
+        videos.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    batch = VideoBatch(videos, color=args.color)
+    batch.process(
+        utils.load_function(args.load),
+        args.n,
+        n_producers = args.producers,
+        queue_size = args.queuesize,
+        batch_size = args.batch,
+        verbose = True
+    )
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import asyncio
+import functools
+import time
+import numpy as np
+import utils
+from async_reader import AsyncVideoReader
+
+### Frames are decoded and processed by the usual producer and consumer
+### processes, results are awaited by an asyncio event loop which stays
+### free for other tasks, here a heartbeat measuring how late it wakes up
+
+def run_load(pfun, frame, frame_num):
+    pfun(frame, frame_num)
+    return frame_num
+
+async def heartbeat(lags, period=0.01):
+    while True:
+        tStt = time.monotonic()
+        await asyncio.sleep(period)
+        lags.append(time.monotonic() - tStt - period)
+
+async def main(reader, pfun, n_consumers, qsize, n_producers, batch_size,
+                tracer, memory):
+    lags = []
+    beat = asyncio.ensure_future(heartbeat(lags))
+    num_frames = 0
+    async with AsyncVideoReader(
+        reader,
+        functools.partial(run_load, pfun),
+        n_consumers,
+        prefetch = qsize,
+        n_producers = n_producers,
+        result_dtype = np.uint64,
+        batch_size = batch_size,
+        trace = tracer,
+        **memory
+    ) as results:
+        async for frame_num, result in results:
+            num_frames += 1
+    beat.cancel()
+    if lags:
+        print("Event loop lag: max {0:.3f}ms, median {1:.3f}ms".format(
+            1000*max(lags),
+            1000*np.median(lags)
+            )
+        )
+    return num_frames
+
+if __name__ == "__main__":
+
+    args = utils.parse_arguments()
+
+    if (args.autoscale or args.supervise is not None or args.pin or
+            args.lockfree):
+        print("--autoscale, --supervise, --pin and --lockfree require the shared memory script")
+        exit()
+
+    ## FORCE HOST
+    args.host = True
+
+    reader = utils.open_reader(args)
+    tracer = utils.open_tracer(reader, args.trace)
+
+    start_time = time.time()
+    num_frames = asyncio.run(
+        main(reader, args.pfun, args.n, args.queuesize, args.producers,
+            args.batch, tracer, args.memory)
+    )
+    stop_time = time.time()
+    utils.close_tracer(tracer, args.trace)
+    duration = stop_time - start_time
+    fps = num_frames/duration
+
+    print("#frames: {0}, duration: {1}, FPS: {2}".format(
+        num_frames,
+        duration,
+        fps
+        )
+    )
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import time
+import utils
+
+### Producers and consumers are threads of a single process sharing a
+### preallocated frame pool. No copy, no pickling, but consumers only run in
+### parallel when the processing releases the GIL (OpenCV, numpy SVD, ...)
+
+if __name__ == "__main__":
+    
+    args = utils.parse_arguments()
+
+    if args.autoscale:
+        print("--autoscale requires the shared memory transport")
+        exit()
+
+    if args.supervise is not None or args.pin:
+        print("--supervise and --pin require worker processes (shm or queue transport)")
+        exit()
+
+    ## FORCE HOST
+    args.host = True
+
+    reader = utils.open_reader(args)
+    tracer = utils.open_tracer(reader, args.trace)
+
+    num_frames = 0
+    start_time = time.time()
+    num_frames = reader.process(
+        args.pfun,
+        args.n,
+        transport = 'threads',
+        queue_size = args.queuesize,
+        n_producers = args.producers,
+        batch_size = args.batch,
+        trace = tracer,
+        verbose = True
+    )
+    stop_time = time.time()
+    utils.close_tracer(tracer, args.trace)
+    duration = stop_time - start_time
+    fps = num_frames/duration
+
+    print("#frames: {0}, duration: {1}, FPS: {2}".format(
+        num_frames, 
+        duration, 
+        fps
+        )
+    )
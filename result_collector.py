@@ -0,0 +1,184 @@
+from multiprocessing.sharedctypes import RawValue
+import heapq
+import itertools
+import time
+import numpy as np
+
+### Workers finish frames out of order. Results are tagged with their frame
+### number, written to a results ring (or queue) and put back in frame order
+### here. Results are held while an earlier frame is missing: with several
+### producers, the results of later chunks wait for the earlier chunks.
+### Results are small, frames are never held here. A ReorderWindow bounds
+### how many of them are held: producers of later chunks pause when they
+### get too far ahead of the next frame in order.
+
+def result_dtype(shape=(), dtype=np.float64):
+    ''' Return the dtype of a results ring slot for fixed-size results '''
+    return np.dtype([('frame_num', np.uint64), ('result', dtype, tuple(shape))])
+
+def write_result(result_buffer, frame_num, result, video=None):
+    ''' Put one result in the results ring, called by workers '''
+    ok, index, slot = result_buffer.acquire_write_slot(block=True)
+    if video is not None:
+        slot['video'] = video
+    slot['frame_num'] = frame_num
+    slot['result'] = result
+    result_buffer.commit(index)
+
+class ReorderBuffer:
+
+    def __init__(self, first=1):
+        '''
+        Reorder (frame_num, result) pairs, frames are numbered from first.
+        A result is held until every earlier frame has arrived or been
+        given up on with skip, nothing is dropped.
+        '''
+        self.next = first
+        self.pending = []
+        # ties between duplicates (a retried item) never compare results
+        self._order = itertools.count()
+        self.given_up = set()
+        # frames missing at flush, neither received nor given up on
+        self.skipped = []
+
+    def push(self, frame_num, result):
+        ''' Add a result, return the list of results now in order '''
+        heapq.heappush(self.pending, (frame_num, next(self._order), result))
+        return self._pop_ready()
+
+    def skip(self, frame_nums):
+        ''' Stop waiting for frames that will never arrive '''
+        self.given_up.update(n for n in frame_nums if n >= self.next)
+        return self._pop_ready()
+
+    def flush(self):
+        ''' Return all pending results in order, missing frames are skipped '''
+        ready = []
+        while self.pending:
+            frame_num, _, result = heapq.heappop(self.pending)
+            if frame_num < self.next:
+                continue
+            self.skipped.extend(
+                n for n in range(self.next, frame_num) if n not in self.given_up
+            )
+            self.next = frame_num + 1
+            ready.append((frame_num, result))
+        return ready
+
+    def _pop_ready(self):
+        ready = []
+        while True:
+            if self.pending and self.pending[0][0] < self.next:
+                # duplicate of a result already delivered
+                heapq.heappop(self.pending)
+            elif self.pending and self.pending[0][0] == self.next:
+                frame_num, _, result = heapq.heappop(self.pending)
+                ready.append((frame_num, result))
+                self.next += 1
+            elif self.next in self.given_up:
+                self.given_up.discard(self.next)
+                self.next += 1
+            else:
+                return ready
+
+class ReorderWindow:
+
+    def __init__(self, size=4096, first=1, stall=10.0):
+        '''
+        Shared bound on the results waiting for an earlier frame. The
+        collector publishes the next frame it needs, producers of chunks
+        that do not hold that frame decode at most size frames past it.
+        The chunk holding it is never paused, so the window cannot
+        deadlock. If the next frame does not change for stall seconds (a
+        result lost with its worker), the bound is lifted for the rest of
+        the run rather than waiting for it forever.
+        '''
+        self.size = size
+        self.stall = stall
+        self.next = RawValue('q', first)
+        self.lifted = RawValue('b', 0)
+
+    def advance(self, next):
+        ''' Called by the collector with the next frame it needs '''
+        self.next.value = next
+
+    def wait(self, frame_num, start):
+        '''
+        Called by a producer before decoding frame frame_num of the chunk
+        that starts after frame start
+        '''
+        delay = 1e-4
+        waiting = None
+        while not self.lifted.value:
+            next = self.next.value
+            if next > start or frame_num < next + self.size:
+                return
+            now = time.monotonic()
+            if waiting is None or waiting[0] != next:
+                waiting = (next, now)
+            elif now - waiting[1] > self.stall:
+                self.lifted.value = 1
+                return
+            time.sleep(delay)
+            delay = min(2*delay, 0.01)
+
+def ring_results(result_buffer):
+    ''' Yield (frame_num, result) from a results ring until it is closed '''
+    while True:
+        ok, index, slot = result_buffer.acquire_read_slot(block=True)
+        if not ok:
+            break
+        frame_num = int(slot['frame_num'])
+        result = slot['result'].copy()
+        result_buffer.release(index)
+        yield frame_num, result
+
+def queue_results(result_queue, sentinel=None):
+    ''' Yield (frame_num, result) from a queue until sentinel is received '''
+    while True:
+        item = result_queue.get()
+        if item is sentinel:
+            break
+        yield item
+
+def ordered(results, first=1, failed=None, window=None, missing=None):
+    '''
+    Yield (frame_num, result) in frame order. failed: list of frame numbers
+    given up on, growing while results arrive (Supervisor.failed). window:
+    ReorderWindow told which frame comes next. missing: list receiving the
+    frames that never got a result and were not given up on
+    '''
+    reorder = ReorderBuffer(first)
+    seen = 0
+    for frame_num, result in results:
+        if failed is not None and len(failed) > seen:
+            given_up = failed[seen:]
+            seen += len(given_up)
+            for item in reorder.skip(given_up):
+                yield item
+        for item in reorder.push(frame_num, result):
+            yield item
+        if window is not None:
+            window.advance(reorder.next)
+    if failed is not None:
+        for item in reorder.skip(failed[seen:]):
+            yield item
+    for item in reorder.flush():
+        yield item
+    if missing is not None:
+        missing.extend(reorder.skipped)
+
+def write_results(results, path, dtype):
+    '''
+    Stream ordered results to a raw file of dtype records, read it back with
+    np.fromfile(path, dtype). Returns the number of results written.
+    '''
+    record = np.zeros(1, dtype=dtype)
+    num_results = 0
+    with open(path, 'wb') as f:
+        for frame_num, result in results:
+            record['frame_num'] = frame_num
+            record['result'] = result
+            f.write(record.tobytes())
+            num_results += 1
+    return num_results
@@ -0,0 +1,156 @@
+from multiprocessing import reduction
+from multiprocessing.sharedctypes import RawArray
+import mmap
+import os
+import warnings
+import weakref
+import numpy as np
+
+### Shared memory for large rings. RawArray zero-fills the whole buffer when
+### it is created and uses 4 KB pages, so that a 4K ring of a few thousand
+### frames costs seconds of memset up front and a page fault every 4 KB on
+### the first pass. Here the buffer is a memfd mapping: pages are allocated
+### (already zeroed by the kernel) on first touch, optionally as 2 MB huge
+### pages, and optionally all of them up front (prefault) so that producers
+### never wait on page faults while decoding.
+###
+### The memfd is inherited by forked processes and passed to spawned ones
+### like multiprocessing passes its own heap.
+
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# madvise option, not exported by the mmap module before Python 3.13
+MADV_POPULATE_WRITE = 23
+
+PAGE_SIZE = mmap.PAGESIZE
+
+def _meminfo(field):
+    ''' Value of a /proc/meminfo field in bytes, None if unknown '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':')
+                if name == field:
+                    return int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def huge_page_size():
+    return _meminfo('Hugepagesize') or 2 << 20
+
+def capacity(spec, item_size):
+    '''
+    Number of ring slots for spec: a number of items (int or '2048'), or a
+    size in bytes with a unit ('512M', '16G'). Warns when the ring would not
+    fit in available memory.
+    '''
+    spec = str(spec).strip().upper().rstrip('B')
+    if spec[-1:] in UNITS:
+        n = int(float(spec[:-1]) * UNITS[spec[-1]]) // item_size
+    else:
+        n = int(spec)
+    if n < 1:
+        raise ValueError('capacity of {0} is less than one item of {1} bytes'.format(
+            spec, item_size))
+    check_available(n*item_size)
+    return n
+
+def check_available(nbytes):
+    ''' Warn if nbytes are more than MemAvailable '''
+    available = _meminfo('MemAvailable')
+    if available is not None and nbytes > available:
+        warnings.warn(
+            "ring of {0:.1f} GB exceeds available memory ({1:.1f} GB), "
+            "reduce the queue size".format(nbytes/2**30, available/2**30),
+            stacklevel=3
+        )
+
+class RingMemory:
+
+    def __init__(self, nbytes, huge_pages=None, prefault=False):
+        '''
+        nbytes of shared memory, in .buf
+
+        huge_pages: None for 4 KB pages, 'transparent' asks the kernel for
+            transparent huge pages (needs
+            /sys/kernel/mm/transparent_hugepage/shmem_enabled set to advise
+            or always), 'explicit' uses pages reserved in
+            /proc/sys/vm/nr_hugepages, falls back to 'transparent' if there
+            are not enough of them
+        prefault: allocate every page now instead of on first touch
+        '''
+        if huge_pages not in (None, 'transparent', 'explicit'):
+            raise ValueError('unknown huge_pages ' + str(huge_pages))
+        self.nbytes = nbytes
+        self.huge_pages = huge_pages
+        self.fd = None
+
+        if not hasattr(os, 'memfd_create'):
+            # not Linux
+            self.buf = RawArray('B', nbytes)
+            return
+
+        fd = None
+        if huge_pages == 'explicit':
+            size = -(-nbytes // huge_page_size()) * huge_page_size()
+            try:
+                fd = os.memfd_create('ring', os.MFD_HUGETLB | os.MFD_CLOEXEC)
+                os.ftruncate(fd, size)
+                # hugetlb pages are reserved when a shared mapping is created
+                self._map(fd, size)
+            except OSError as e:
+                if fd is not None:
+                    os.close(fd)
+                fd = None
+                warnings.warn(
+                    "no huge pages for a {0:.1f} GB ring ({1}), see "
+                    "/proc/sys/vm/nr_hugepages; using transparent huge "
+                    "pages".format(nbytes/2**30, e.strerror),
+                    stacklevel=2
+                )
+                self.huge_pages = 'transparent'
+        if fd is None:
+            size = nbytes
+            if self.huge_pages == 'transparent':
+                size = -(-nbytes // huge_page_size()) * huge_page_size()
+            fd = os.memfd_create('ring', os.MFD_CLOEXEC)
+            os.ftruncate(fd, size)
+            self._map(fd, size)
+        weakref.finalize(self, os.close, fd)
+
+        if prefault:
+            self.prefault()
+
+    def _map(self, fd, size):
+        self.fd = fd
+        self.size = size
+        self.buf = mmap.mmap(fd, size)
+        if self.huge_pages == 'transparent':
+            self.buf.madvise(mmap.MADV_HUGEPAGE)
+
+    def prefault(self):
+        ''' Allocate every page of this process' mapping '''
+        if self.fd is None:
+            # RawArray is zero-filled, already faulted
+            return
+        try:
+            # Linux 5.14+, without writing to the pages
+            self.buf.madvise(MADV_POPULATE_WRITE)
+        except OSError:
+            np.frombuffer(self.buf, np.uint8)[::PAGE_SIZE] = 0
+
+    def __getstate__(self):
+        # only when starting a process: the child maps the same memfd
+        state = self.__dict__.copy()
+        if self.fd is not None:
+            state['fd'] = reduction.DupFd(self.fd)
+            del state['buf']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.fd is not None:
+            fd = self.fd.detach()
+            self._map(fd, self.size)
+            weakref.finalize(self, os.close, fd)
@@ -1,132 +1,329 @@
-from multiprocessing import Process, Lock
+from multiprocessing import Process, Lock, Semaphore, Pipe
 from multiprocessing.sharedctypes import RawArray, RawValue
+import os
 import time
 import numpy as np
+from ring_memory import RingMemory
 
 class SharedRingBuffer:
-    
+
     def __init__(
-        self, 
-        maxNumItems, 
+        self,
+        maxNumItems,
         itemSize = 1,
-        buftype = 'B'
+        buftype = 'B',
+        dtype = None,
+        notify = False,
+        huge_pages = None,
+        prefault = False
     ):
-        ''' Allocate shared array '''
-        
+        '''
+        Allocate shared array. notify: create a wakeup pipe for event loops,
+        see fileno. huge_pages and prefault: see ring_memory.RingMemory
+        '''
+
         #TODO check input args type/size/values
 
+        # items can be described by a numpy (structured) dtype, slots are
+        # then records of that dtype
+        if dtype is not None:
+            dtype = np.dtype(dtype)
+            itemSize = dtype.itemsize
+            buftype = 'B'
+        self.dtype = dtype
         self.maxNumItems = maxNumItems
         self.itemSize = itemSize
         self.totalSize = maxNumItems*itemSize
         self.buftype = buftype
-        self.data = RawArray(buftype, maxNumItems*itemSize)
+        # pages are allocated on first touch, not zero-filled here
+        self.data = RingMemory(
+            maxNumItems*itemSize*np.dtype(buftype).itemsize,
+            huge_pages,
+            prefault
+        )
+        # cursors are slot indices. Slots go through four stages:
+        # reserved by a writer, committed, leased by a reader, released.
+        # Writers and readers may finish out of order, the commit and release
+        # cursors only move past contiguous finished slots.
         self.write_cursor = RawValue('i',0)
+        self.commit_cursor = RawValue('i',0)
         self.read_cursor = RawValue('i',0)
+        self.release_cursor = RawValue('i',0)
+        self.committed = RawArray('b', maxNumItems)
+        self.released = RawArray('b', maxNumItems)
+        # slots shared by several readers are released when their reference
+        # count drops to zero, see retain/unref
+        self.refs = RawArray('i', maxNumItems)
         self.rLock = Lock()
         self.wLock = Lock()
+        # count free and filled slots so that blocked producers/consumers
+        # sleep in the kernel and are woken up as soon as a slot is available.
+        # One slot is kept empty to tell full and empty apart.
+        self.free_slots = Semaphore(maxNumItems-1)
+        self.filled_slots = Semaphore(0)
+        # end of stream is signaled out of band, not with a magic item
+        self.closed_flag = RawValue('b',0)
+        # total time (s) writers waited for a free slot and readers waited
+        # for an item, used to monitor the pipeline. Waits in progress are
+        # counted as [number of waiters, sum of their start times], so that
+        # a long wait shows up while it lasts, see wait_time
+        self.write_wait = RawValue('d',0)
+        self.read_wait = RawValue('d',0)
+        self.write_waiting = RawArray('d', 2)
+        self.read_waiting = RawArray('d', 2)
+        # a byte is written to this pipe when slots are committed or the
+        # buffer is closed, so that an event loop can wait for items without
+        # blocking on the semaphore
+        self.wakeup = None
+        if notify:
+            self.wakeup = Pipe(duplex=False)
+            for conn in self.wakeup:
+                os.set_blocking(conn.fileno(), False)
         self._debug = False
+        self._slots = None
+
+    def __getstate__(self):
+        # numpy views are rebuilt in each process
+        state = self.__dict__.copy()
+        state['_slots'] = None
+        return state
+
+    def slots(self):
+        '''
+        Return a (maxNumItems, itemSize) numpy view of the shared array,
+        or a (maxNumItems,) array of records if the buffer has a dtype
+        '''
+        if self._slots is None and self.dtype is not None:
+            self._slots = np.frombuffer(
+                self.data.buf,
+                dtype=self.dtype,
+                count=self.maxNumItems
+            )
+        elif self._slots is None:
+            self._slots = np.frombuffer(
+                self.data.buf,
+                dtype=np.dtype(self.buftype),
+                count=self.totalSize
+            ).reshape(self.maxNumItems, self.itemSize)
+        return self._slots
 
     def full(self):
         return self.write_cursor.value == (
-            (self.read_cursor.value - self.itemSize) % self.totalSize
+            (self.release_cursor.value - 1) % self.maxNumItems
             )
 
     def empty(self):
-        return self.write_cursor.value == self.read_cursor.value
+        return self.commit_cursor.value == self.read_cursor.value
+
+    def close(self):
+        '''
+        Signal end of stream. Readers drain the remaining items, then
+        acquire_read_slot/pop return False instead of blocking.
+        '''
+        self.closed_flag.value = 1
+        # one extra permit wakes up a reader, which hands it over to the next
+        self.filled_slots.release()
+        self._notify()
+
+    def closed(self):
+        return self.closed_flag.value == 1
+
+    def fileno(self):
+        '''
+        File descriptor of the wakeup pipe (notify=True), readable when
+        items were committed or the buffer closed since the last
+        clear_wakeup. Register it with an event loop, then clear_wakeup and
+        acquire_read_slot(block=False, timeout=0) when it is readable.
+        '''
+        return self.wakeup[0].fileno()
+
+    def clear_wakeup(self):
+        ''' Consume pending wakeups '''
+        try:
+            while os.read(self.fileno(), 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _notify(self):
+        if self.wakeup is None:
+            return
+        try:
+            os.write(self.wakeup[1].fileno(), b'\0')
+        except BlockingIOError:
+            # pipe full: the reader has wakeups pending anyway
+            pass
 
     def check(self,item):
         # TODO check size
         # TODO check type, has to be a bytes object (np array with ndim = 1 works)
-        
+
         pass
 
+    def _wait(self, semaphore, lock, total, waiting, block, timeout):
+        # sleep on the semaphore, registered as a wait in progress
+        tStart = time.monotonic()
+        with lock:
+            waiting[0] += 1
+            waiting[1] += tStart
+        ok = semaphore.acquire(True, None if block else timeout)
+        tStop = time.monotonic()
+        with lock:
+            waiting[0] -= 1
+            waiting[1] -= tStart
+            total.value += tStop - tStart
+        return ok
+
+    def wait_time(self):
+        ''' Return (write, read) seconds waited so far, waits in progress included '''
+        now = time.monotonic()
+        with self.wLock:
+            write = self.write_wait.value + \
+                self.write_waiting[0]*now - self.write_waiting[1]
+        with self.rLock:
+            read = self.read_wait.value + \
+                self.read_waiting[0]*now - self.read_waiting[1]
+        return write, read
+
+    def acquire_write_slot(self, block=False, timeout=0.1):
+        '''
+        Reserve the slot at the back and return (ok, index, view).
+        Fill the view in place then call commit(index).
+        '''
+
+        # if buffer is full wait until data is read
+        if not self.free_slots.acquire(False):
+            ok = self._wait(self.free_slots, self.wLock, self.write_wait,
+                            self.write_waiting, block, timeout)
+            if not ok:
+                return (False, -1, None)
+
+        self.wLock.acquire()
+        index = self.write_cursor.value
+        self.write_cursor.value = (index + 1) % self.maxNumItems
+        self.wLock.release()
+
+        return (True, index, self.slots()[index])
+
+    def commit(self, index):
+        ''' Make a slot filled with acquire_write_slot visible to readers '''
+
+        self.wLock.acquire()
+        self.committed[index] = 1
+        # publish all contiguous committed slots
+        num_ready = 0
+        while self.committed[self.commit_cursor.value]:
+            self.committed[self.commit_cursor.value] = 0
+            self.commit_cursor.value = (
+                (self.commit_cursor.value + 1) % self.maxNumItems
+            )
+            num_ready += 1
+        self.wLock.release()
+
+        # wake up readers
+        for i in range(num_ready):
+            self.filled_slots.release()
+        if num_ready:
+            self._notify()
+
+    def acquire_read_slot(self, block=False, timeout=0.1):
+        '''
+        Lease the slot at the front and return (ok, index, view).
+        The view stays valid until release(index) is called.
+        '''
+
+        # wait until there is something to read
+        if not self.filled_slots.acquire(False):
+            ok = self._wait(self.filled_slots, self.rLock, self.read_wait,
+                            self.read_waiting, block, timeout)
+            if not ok:
+                return (False, -1, None)
+
+        self.rLock.acquire()
+        if self.closed() and self.empty():
+            # this is the end of stream permit, pass it on
+            self.rLock.release()
+            self.filled_slots.release()
+            return (False, -1, None)
+        index = self.read_cursor.value
+        self.read_cursor.value = (index + 1) % self.maxNumItems
+        self.rLock.release()
+
+        return (True, index, self.slots()[index])
+
+    def release(self, index):
+        ''' Give a slot leased with acquire_read_slot back to writers '''
+
+        self.rLock.acquire()
+        self.released[index] = 1
+        # free all contiguous released slots
+        num_free = 0
+        while self.released[self.release_cursor.value]:
+            self.released[self.release_cursor.value] = 0
+            self.release_cursor.value = (
+                (self.release_cursor.value + 1) % self.maxNumItems
+            )
+            num_free += 1
+        self.rLock.release()
+
+        # wake up writers
+        for i in range(num_free):
+            self.free_slots.release()
+
+    def retain(self, index, count):
+        '''
+        Called by the writer before commit: the slot is released after
+        unref(index) has been called count times, instead of by release
+        '''
+        self.refs[index] = count
+
+    def unref(self, indices):
+        ''' Drop a reference to each slot, release the ones no longer used '''
+
+        self.rLock.acquire()
+        unused = []
+        for index in indices:
+            self.refs[index] -= 1
+            if self.refs[index] == 0:
+                unused.append(index)
+        self.rLock.release()
+
+        for index in unused:
+            self.release(index)
+
     def push(self, item, block=False, timeout=0.1):
-        ''' Add item at the back '''
-        
+        ''' Add item at the back, return False if no slot became free '''
+
         # check that item is the right size/type
         self.check(item)
-        self.wLock.acquire()
-        # if buffer is full wait until data is read
-        if block:
-            while self.full():
-                self.wLock.release()
-                time.sleep(timeout)
-                self.wLock.acquire()
-        else:
-            tStart = tNow = time.monotonic()
-            while tNow-tStart < timeout and self.full():
-                self.wLock.release()
-                time.sleep(timeout)
-                tNow = time.monotonic()
-                self.wLock.acquire()
-            
-            if tNow-tStart >= timeout: # timeout occured
-                self.wLock.release()
-                return
-        
-        # update buffer, use memoryview for direct buffer access 
-        idx_start = self.write_cursor.value
-        idx_stop = idx_start + self.itemSize
-        if self.buftype == 'B':
-            mview = memoryview(self.data).cast('B')
-        elif self.buftype == 'i':
-            mview = memoryview(self.data).cast('B').cast('i')
-        
-        if self.itemSize == 1:
-            mview[idx_start] = item
-        else:
-            mview[idx_start:idx_stop] = item
-        
-        # update write cursor
-        self.write_cursor.value = idx_stop % self.totalSize
-        self.wLock.release()
+
+        ok, index, slot = self.acquire_write_slot(block, timeout)
+        if not ok:
+            return False
+        self.slots()[index] = item
+        self.commit(index)
+        return True
 
     def pop(self, block=False, timeout=0.1):
         ''' Return item from the front '''
 
-        self.rLock.acquire()
-        # check if buffer is not empty
-        if block:
-            while self.empty():
-                self.rLock.release()
-                time.sleep(timeout)
-                self.rLock.acquire()
-        else:
-            tStart = tNow = time.monotonic()
-            while self.empty() and tNow-tStart < timeout:
-                self.rLock.release()
-                time.sleep(timeout)
-                tNow = time.monotonic()
-                self.rLock.acquire()
-
-            if tNow-tStart >= timeout: # timeout occured
-                self.rLock.release()
-                return (False, [])
-
-        idx_start = self.read_cursor.value
-        idx_stop = idx_start + self.itemSize
-        # fetch item, use memoryview for direct buffer access
-        if self.buftype == 'B':
-            mview = memoryview(self.data).cast('B')
-        elif self.buftype == 'i':
-            mview = memoryview(self.data).cast('B').cast('i')
-
-        # make a copy outside of the buffer before you return it     
-        if self.itemSize == 1:
-            item = mview[idx_start]
+        ok, index, slot = self.acquire_read_slot(block, timeout)
+        if not ok:
+            return (False, [])
+
+        # make a copy outside of the buffer before you return it
+        if self.dtype is None and self.itemSize == 1:
+            item = slot[0].item()
         else:
-            item = np.array(mview[idx_start:idx_stop],copy=True)
-        
-        # update read cursor
-        self.read_cursor.value = idx_stop % self.totalSize
-        self.rLock.release()
+            item = slot.copy()
+        self.release(index)
 
         return True, item
 
     def size(self):
         ''' Return number of items currently stored in the buffer '''
         return (
-            (self.write_cursor.value - self.read_cursor.value) % self.totalSize
+            (self.commit_cursor.value - self.read_cursor.value) % self.maxNumItems
             )
 
-    
+
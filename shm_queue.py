@@ -0,0 +1,133 @@
+from multiprocessing import Lock, Queue, Semaphore
+from multiprocessing.sharedctypes import RawArray, RawValue
+import pickle
+import queue
+import weakref
+import numpy as np
+
+### multiprocessing.Queue interface without pickling frames through a pipe.
+### Items are pickled with protocol 5: large buffers (numpy arrays) are
+### taken out-of-band and copied into a block of a preallocated shared
+### memory pool, only the small pickle and the block number go through the
+### underlying Queue. get() rebuilds the item with arrays that are views of
+### the block, the block goes back to the pool when they are garbage
+### collected. Consumers holding on to frames therefore hold blocks, and
+### put() waits for a free block like it waits for a free queue entry.
+
+# buffers smaller than this stay in the pickle
+MIN_OUT_OF_BAND = 4096
+# out-of-band buffers are aligned in a block, for vectorized processing
+ALIGN = 64
+
+class SharedMemoryQueue:
+
+    def __init__(self, maxsize, block_size, n_blocks=None):
+        '''
+        maxsize: number of items in the queue, as for multiprocessing.Queue
+        block_size: bytes of out-of-band data per item, e.g. one frame or a
+            batch of frames. Bigger items are pickled in-band, as Queue does.
+        n_blocks: blocks in the pool, at least maxsize plus the items held
+            by consumers and producers at any time (default maxsize + 8)
+        '''
+        if n_blocks is None:
+            n_blocks = maxsize + 8
+        self.maxsize = maxsize
+        self.block_size = block_size
+        self.n_blocks = n_blocks
+        self.data = RawArray('B', n_blocks*block_size)
+        self.queue = Queue(maxsize)
+        # stack of free block numbers, the semaphore counts them
+        self.free = RawArray('i', range(n_blocks))
+        self.num_free = RawValue('i', n_blocks)
+        self.free_slots = Semaphore(n_blocks)
+        self.lock = Lock()
+        self._blocks = None
+
+    def __getstate__(self):
+        # numpy views are rebuilt in each process
+        state = self.__dict__.copy()
+        state['_blocks'] = None
+        return state
+
+    def blocks(self):
+        ''' Return a (n_blocks, block_size) view of the pool '''
+        if self._blocks is None:
+            self._blocks = np.frombuffer(self.data, np.uint8).reshape(
+                self.n_blocks, self.block_size
+            )
+        return self._blocks
+
+    def _acquire_block(self, block, timeout):
+        if not self.free_slots.acquire(block, timeout):
+            raise queue.Full
+        with self.lock:
+            self.num_free.value -= 1
+            return self.free[self.num_free.value]
+
+    def _release_block(self, index):
+        with self.lock:
+            self.free[self.num_free.value] = index
+            self.num_free.value += 1
+        self.free_slots.release()
+
+    def put(self, obj, block=True, timeout=None):
+        buffers = []
+        def out_of_band(buffer):
+            # returning True keeps the buffer in the pickle
+            if buffer.raw().nbytes < MIN_OUT_OF_BAND:
+                return True
+            buffers.append(buffer)
+            return False
+        data = pickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+
+        layout = []
+        offset = 0
+        for buffer in buffers:
+            nbytes = buffer.raw().nbytes
+            layout.append((offset, nbytes))
+            offset += -(-nbytes // ALIGN) * ALIGN
+        if not buffers or offset > self.block_size:
+            # nothing to share, or too big for a block
+            self.queue.put((pickle.dumps(obj), -1, None), block, timeout)
+            return
+
+        index = self._acquire_block(block, timeout)
+        target = self.blocks()[index]
+        for buffer, (offset, nbytes) in zip(buffers, layout):
+            target[offset:offset+nbytes] = np.frombuffer(buffer.raw(), np.uint8)
+        try:
+            self.queue.put((data, index, layout), block, timeout)
+        except queue.Full:
+            self._release_block(index)
+            raise
+
+    def get(self, block=True, timeout=None):
+        data, index, layout = self.queue.get(block, timeout)
+        if index < 0:
+            return pickle.loads(data)
+        # a new array for this item only: the rebuilt arrays keep it alive
+        # through their base, the block is free again once it is collected
+        owner = np.frombuffer(
+            self.data,
+            np.uint8,
+            count=self.block_size,
+            offset=index*self.block_size
+        )
+        weakref.finalize(owner, self._release_block, index)
+        views = [owner[offset:offset+nbytes] for offset, nbytes in layout]
+        return pickle.loads(data, buffers=views)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def full(self):
+        return self.queue.full()
+
+    def close(self):
+        self.queue.close()
+
+    def join_thread(self):
+        self.queue.join_thread()
@@ -0,0 +1,111 @@
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray
+import time
+
+### Supervision of worker processes. Each worker records in shared memory
+### the item it is processing (ring slot and frame numbers) and when it
+### took it. The main process waits on the process sentinels, so a crash is
+### seen as soon as it happens, and a worker is declared hung when a single
+### item takes longer than `timeout`. Dead or hung workers are replaced, the
+### replacement first processes the item the dead worker was holding. An
+### item that keeps killing workers is given up after max_retries, its
+### frames are reported in Supervisor.failed.
+###
+### A heartbeat thread in the worker would keep beating while process_fun
+### is stuck in C code, so progress (time the current item was taken) is
+### what is watched instead.
+###
+### A queue item is only recorded once the worker holds it, a worker killed
+### in between takes it with it. Workers flag that they are taking an item,
+### and the frames they begin are marked as seen: when a worker dies while
+### taking, the frames that were queued but never seen are decoded again
+### once the other workers are done.
+
+class WorkerState:
+
+    def __init__(self, max_workers, num_frames=0):
+        '''
+        Item in flight for each worker number. num_frames > 0 also records
+        which frames were begun, for items taken from a queue.
+        '''
+        self.slot = RawArray('q', max_workers)    # leased ring slot, -1 if none
+        self.first = RawArray('q', max_workers)   # first frame number, 0 when idle
+        self.count = RawArray('q', max_workers)
+        self.beat = RawArray('d', max_workers)    # time the item was taken
+        self.taking = RawArray('b', max_workers)  # between queue get and begin
+        self.seen = RawArray('b', num_frames + 1) if num_frames > 0 else None
+        # held by a worker while it gives its slot back and ends the item,
+        # so that the supervisor never sees a released slot as in flight
+        self.lock = Lock()
+        for i in range(max_workers):
+            self.slot[i] = -1
+
+    def take(self, worker_num):
+        ''' Called before getting an item from a queue '''
+        self.taking[worker_num] = 1
+
+    def begin(self, worker_num, slot, first, count):
+        self.slot[worker_num] = slot
+        self.count[worker_num] = count
+        self.beat[worker_num] = time.monotonic()
+        # written last, marks the record as valid
+        self.first[worker_num] = first
+        if self.seen is not None:
+            for frame_num in range(first, min(first + count, len(self.seen))):
+                self.seen[frame_num] = 1
+        self.taking[worker_num] = 0
+
+    def end(self, worker_num):
+        self.first[worker_num] = 0
+        self.slot[worker_num] = -1
+        self.taking[worker_num] = 0
+
+    def in_flight(self, worker_num):
+        ''' Return (slot, frame numbers) of the item in flight, or None '''
+        first = self.first[worker_num]
+        if first == 0:
+            return None
+        return self.slot[worker_num], list(range(first, first + self.count[worker_num]))
+
+    def unseen(self, frame_nums):
+        ''' Frames no worker has begun '''
+        return [n for n in frame_nums if n < len(self.seen) and not self.seen[n]]
+
+    def hung(self, worker_num, timeout):
+        return (
+            self.first[worker_num] != 0
+            and time.monotonic() - self.beat[worker_num] > timeout
+        )
+
+class Supervisor:
+
+    def __init__(self, timeout=60.0, max_retries=2, max_restarts=16):
+        '''
+        timeout: seconds a worker may spend on one item (batch) before it is
+            considered hung and killed
+        max_retries: times an item is handed to a new worker after killing
+            one, its frames are then given up
+        max_restarts: workers replaced in total before the run is aborted
+        '''
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        # frame numbers given up on
+        self.failed = []
+        self._retries = {}
+
+    def retry(self, frame_nums):
+        ''' Count an attempt for an item, False once it should be given up '''
+        key = frame_nums[0]
+        self._retries[key] = self._retries.get(key, 0) + 1
+        return self._retries[key] <= self.max_retries
+
+    def give_up(self, frame_nums):
+        self.failed.extend(frame_nums)
+
+    def report(self):
+        return "{0} workers restarted, {1} frames failed".format(
+            self.restarts,
+            len(self.failed)
+        )
@@ -0,0 +1,272 @@
+from multiprocessing.sharedctypes import RawArray
+import json
+import threading
+import time
+import numpy as np
+
+### Per-frame pipeline timestamps, to tell whether a run is decode, color
+### conversion, transport or processing bound.
+###
+### Producers and workers write time.monotonic() (shared by all processes)
+### into a preallocated shared array, one row per frame and one column per
+### point of the pipeline. Consecutive points delimit the stages:
+###
+###   START -decode-> DECODE -cvtColor-> CVTCOLOR -enqueue-> ENQUEUE
+###     -queued-> DEQUEUE -process-> PROCESS -done-> DONE
+###
+### Each process only writes its own rows and its own counters, no lock is
+### needed. Frames beyond max_frames are not traced.
+
+START, DECODE, CVTCOLOR, ENQUEUE, DEQUEUE, PROCESS, DONE = range(7)
+POINTS = ['start', 'decode', 'cvtColor', 'enqueue', 'dequeue', 'process', 'done']
+STAGES = ['decode', 'cvtColor', 'enqueue', 'queued', 'process', 'done']
+
+# live counters, one row per producer and per worker
+FRAMES, WAITS, WAIT_TIME = range(3)
+
+class Tracer:
+
+    def __init__(
+        self,
+        max_frames,
+        max_producers = 64,
+        max_workers = 256,
+        wait_threshold = 100e-6,
+        interval = 0.1
+    ):
+        '''
+        max_frames: number of frames that can be traced, frame numbers start
+            at 1
+        wait_threshold: an acquire longer than this (s) counts as a producer
+            stall or a worker idle wait
+        interval: period (s) of ring occupancy sampling
+        '''
+        self.max_frames = max_frames
+        self.max_producers = max_producers
+        self.max_workers = max_workers
+        self.wait_threshold = wait_threshold
+        self.interval = interval
+        self.times = RawArray('d', max_frames*len(POINTS))
+        self.producer = RawArray('h', max_frames)
+        self.worker = RawArray('h', max_frames)
+        self.producer_counters = RawArray('d', max_producers*3)
+        self.worker_counters = RawArray('d', max_workers*3)
+        # (time, occupancy) samples, only in the main process
+        self.occupancy = []
+        self._monitor = None
+        self._stop = None
+        self._views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None
+        state['_monitor'] = None
+        state['_stop'] = None
+        state['occupancy'] = []
+        return state
+
+    def views(self):
+        ''' Return numpy views (times, producer, worker) of the shared arrays '''
+        if self._views is None:
+            self._views = (
+                np.frombuffer(self.times, dtype=np.float64).reshape(
+                    self.max_frames, len(POINTS)
+                ),
+                np.frombuffer(self.producer, dtype=np.int16),
+                np.frombuffer(self.worker, dtype=np.int16)
+            )
+        return self._views
+
+    def stamp(self, frame_num, point, t=None):
+        ''' Record time t (now by default) of a point for a frame '''
+        if 0 < frame_num <= self.max_frames:
+            if t is None:
+                t = time.monotonic()
+            self.times[(frame_num-1)*len(POINTS) + point] = t
+
+    def stamp_many(self, frame_nums, point, t=None):
+        ''' Same time for all the frames of a batch '''
+        if t is None:
+            t = time.monotonic()
+        for frame_num in frame_nums:
+            self.stamp(int(frame_num), point, t)
+
+    def decoded(self, frame_num, producer_num, t_start, t_decode):
+        ''' Producer side: frame read (t_start, t_decode) and converted (now) '''
+        if 0 < frame_num <= self.max_frames:
+            row = (frame_num-1)*len(POINTS)
+            self.times[row + START] = t_start
+            self.times[row + DECODE] = t_decode
+            self.times[row + CVTCOLOR] = time.monotonic()
+            self.producer[frame_num-1] = producer_num
+        self.producer_counters[producer_num*3 + FRAMES] += 1
+
+    def dequeued(self, frame_nums, worker_num, t):
+        self.stamp_many(frame_nums, DEQUEUE, t)
+        for frame_num in frame_nums:
+            if 0 < frame_num <= self.max_frames:
+                self.worker[int(frame_num)-1] = worker_num
+        self.worker_counters[worker_num*3 + FRAMES] += len(frame_nums)
+
+    def producer_wait(self, producer_num, duration):
+        ''' Producer waited duration (s) for a free slot '''
+        if duration > self.wait_threshold:
+            self.producer_counters[producer_num*3 + WAITS] += 1
+            self.producer_counters[producer_num*3 + WAIT_TIME] += duration
+
+    def worker_wait(self, worker_num, duration):
+        ''' Worker waited duration (s) for a frame '''
+        if duration > self.wait_threshold:
+            self.worker_counters[worker_num*3 + WAITS] += 1
+            self.worker_counters[worker_num*3 + WAIT_TIME] += duration
+
+    def counters(self):
+        ''' Return live totals over producers and workers '''
+        producers = np.frombuffer(self.producer_counters).reshape(-1, 3)
+        workers = np.frombuffer(self.worker_counters).reshape(-1, 3)
+        return {
+            'decoded': int(producers[:, FRAMES].sum()),
+            'dequeued': int(workers[:, FRAMES].sum()),
+            'producer_stalls': int(producers[:, WAITS].sum()),
+            'producer_stall_time': float(producers[:, WAIT_TIME].sum()),
+            'worker_idle_waits': int(workers[:, WAITS].sum()),
+            'worker_idle_time': float(workers[:, WAIT_TIME].sum()),
+            'occupancy': self.occupancy[-1][1] if self.occupancy else 0.0
+        }
+
+    def start_monitor(self, occupancy, verbose=False):
+        '''
+        Sample occupancy() (fraction of the frame buffer in use) every
+        interval in a thread of the main process, print the counters if
+        verbose
+        '''
+        self._stop = threading.Event()
+
+        def monitor():
+            last_print = time.monotonic()
+            while not self._stop.wait(self.interval):
+                try:
+                    value = occupancy()
+                except NotImplementedError:
+                    # Queue.qsize is not available on macOS
+                    value = np.nan
+                self.occupancy.append((time.monotonic(), value))
+                if verbose and time.monotonic() - last_print > 1:
+                    last_print = time.monotonic()
+                    print("Trace: {decoded} decoded, {dequeued} dequeued, "
+                        "buffer {occ:.0f}%, {producer_stalls} producer stalls, "
+                        "{worker_idle_waits} idle waits".format(
+                        occ=100*value, **self.counters()
+                        )
+                    )
+
+        self._monitor = threading.Thread(target=monitor, daemon=True)
+        self._monitor.start()
+
+    def stop_monitor(self):
+        if self._monitor is not None:
+            self._stop.set()
+            self._monitor.join()
+            self._monitor = None
+
+    def stage_durations(self):
+        ''' Return {stage: durations (s)} of the frames that went through '''
+        times, producer, worker = self.views()
+        complete = times[np.all(times > 0, axis=1)]
+        return {
+            stage: complete[:, i+1] - complete[:, i]
+            for i, stage in enumerate(STAGES)
+        }
+
+    def summary(self):
+        ''' Median, p99 and total time of each stage '''
+        summary = {}
+        for stage, durations in self.stage_durations().items():
+            if len(durations) == 0:
+                continue
+            summary[stage] = {
+                'p50_ms': 1000 * float(np.percentile(durations, 50)),
+                'p99_ms': 1000 * float(np.percentile(durations, 99)),
+                'total_s': float(durations.sum())
+            }
+        summary['counters'] = self.counters()
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        for stage in STAGES:
+            if stage in summary:
+                print("{0:>9}: p50 {1:8.3f} ms, p99 {2:8.3f} ms, total {3:8.3f} s".format(
+                    stage,
+                    summary[stage]['p50_ms'],
+                    summary[stage]['p99_ms'],
+                    summary[stage]['total_s']
+                    )
+                )
+        print(summary['counters'])
+
+    def export_chrome(self, path):
+        '''
+        Write a Chrome trace (chrome://tracing, ui.perfetto.dev): one track
+        per producer and per worker, one slice per stage and frame, and the
+        buffer occupancy as a counter. Time in microseconds.
+        '''
+        times, producer, worker = self.views()
+        traced = np.nonzero(np.any(times > 0, axis=1))[0]
+        t0 = times[times > 0].min() if len(traced) else 0
+
+        events = []
+        names = {}
+        for i in traced:
+            frame_num = int(i) + 1
+            row = times[i]
+            for s, stage in enumerate(STAGES):
+                begin, end = row[s], row[s+1]
+                if begin <= 0 or end <= 0:
+                    continue
+                if stage == 'queued':
+                    # frames overlap in the buffer, async slices
+                    for ph, t in [('b', begin), ('e', end)]:
+                        events.append({
+                            'name': stage,
+                            'cat': 'buffer',
+                            'ph': ph,
+                            'id': frame_num,
+                            'pid': 1,
+                            'ts': 1e6 * (t - t0)
+                        })
+                    continue
+                if stage in ('decode', 'cvtColor', 'enqueue'):
+                    tid = 'producer {0}'.format(producer[i])
+                else:
+                    tid = 'worker {0}'.format(worker[i])
+                names.setdefault(tid, len(names) + 1)
+                events.append({
+                    'name': stage,
+                    'ph': 'X',
+                    'pid': 1,
+                    'tid': names[tid],
+                    'ts': 1e6 * (begin - t0),
+                    'dur': 1e6 * (end - begin),
+                    'args': {'frame': frame_num}
+                })
+        for tid, n in names.items():
+            events.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': 1,
+                'tid': n,
+                'args': {'name': tid}
+            })
+        for t, value in self.occupancy:
+            if t >= t0 and not np.isnan(value):
+                events.append({
+                    'name': 'buffer occupancy',
+                    'ph': 'C',
+                    'pid': 1,
+                    'ts': 1e6 * (t - t0),
+                    'args': {'percent': 100 * value}
+                })
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
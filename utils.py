@@ -3,15 +3,6 @@ import time
 import argparse
 import cv2
 import os
-import struct 
-
-def int32_to_uint8x4(n):
-    int32 = struct.pack("I", n)
-    return struct.unpack("B" * 4, int32)
-
-def uint8x4_to_int32(u0,u1,u2,u3):
-    int32 = struct.pack('BBBB',u0,u1,u2,u3)
-    return struct.unpack("I", int32)[0]
 
 def busy_wait(dt):
     current_time = time.time()
@@ -36,13 +27,37 @@ def synthetic_load_multi_core(frame,frame_num):
         raise TypeError('frame in GPU mem, use --host option') 
     else:
         try:
-            frame32 = np.float32(frame)                                                 
+            # producers can already deliver float32 frames (--float)
+            if frame.dtype == np.float32:
+                frame32 = frame
+            else:
+                frame32 = np.float32(frame)
             u, s, vh = np.linalg.svd(frame32)
             #print(frame_num)
         except np.linalg.LinAlgError:
             pass
             #print(str(frame_num) + ' SVD did not converge')
 
+def load_function(load):
+    """Synthetic load for the --load option"""
+
+    if (load == "MC"):
+        return synthetic_load_multi_core
+    elif (load == "SC"):
+        return synthetic_load_single_core
+    elif (load == "L"):
+        return synthetic_load_light
+    elif (load == "N"):
+        return do_nothing
+    elif (load == "BG"):
+        from kernels import BackgroundSubtraction
+        return BackgroundSubtraction()
+    elif (load == "BLOB"):
+        from kernels import BlobStatistics
+        return BlobStatistics()
+    else:
+        raise ValueError
+
 def time_exec(fun):
     startTime = time.time()
     ret = fun()
@@ -50,6 +65,46 @@ def time_exec(fun):
     duration = stopTime - startTime
     return ret, duration
 
+def open_reader(args):
+    """VideoReader for the command line options, see parse_arguments"""
+
+    # imported here, scripts that do not read videos should not need it
+    from video_reader import VideoReader
+
+    if args.pyav_options is not None:
+        backend, options = 'pyav', dict(args.pyav_options)
+    elif args.gpu and args.cvcuda:
+        backend, options = 'cudacodec', {'host': args.host}
+    elif args.gpu:
+        backend, options = 'cuvid', {}
+    else:
+        backend, options = 'cpu', {}
+
+    if args.luma:
+        options['luma'] = True
+    if args.preprocess is not None:
+        options['preprocess'] = args.preprocess
+    if args.cache:
+        # decode once with the chosen backend, replay the cached frames
+        return VideoReader(args.videofile, 'cache', args.color, source=backend,
+                            **options)
+    return VideoReader(args.videofile, backend, args.color, **options)
+
+def open_tracer(reader, tracefile):
+    """Tracer for all the frames of the video, None if not tracing"""
+
+    if tracefile is None:
+        return None
+    from tracing import Tracer
+    # the frame count from the container can be approximate
+    return Tracer(int(reader.num_frames * 1.1) + 100)
+
+def close_tracer(tracer, tracefile):
+    if tracer is not None:
+        tracer.print_summary()
+        tracer.export_chrome(tracefile)
+        print("Trace written to " + tracefile)
+
 def parse_arguments():
     
     parser = argparse.ArgumentParser(
@@ -64,7 +119,7 @@ def parse_arguments():
         '--load',                                                               
         type = str,                                                             
         default = "MC",                                                         
-        help = 'Synthetic load: light L, single core SC, multicore MC'          
+        help = 'Synthetic load: light L, single core SC, multicore MC, none N; kernels: background subtraction BG, blob statistics BLOB'
     )
     parser.add_argument(
         '-n',
@@ -75,9 +130,9 @@ def parse_arguments():
     parser.add_argument(
         '--queuesize',
         '-q',
-        default = 2048,
-        type = int,
-        help = 'Max size of the frame buffer'
+        default = '2048',
+        type = str,
+        help = 'Max size of the frame buffer, in frames or in bytes (e.g. 8G)'
     )
     parser.add_argument(
         '--gpu',
@@ -94,30 +149,189 @@ def parse_arguments():
         action = 'store_true',
         help = 'Get image data from GPU to host'
     )
+    parser.add_argument(
+        '--producers',
+        '-p',
+        type = int,
+        default = 1,
+        help = 'number of producer processes decoding chunks of the video'
+    )
+    parser.add_argument(
+        '--batch',
+        '-b',
+        type = int,
+        default = 1,
+        help = 'number of consecutive frames delivered to a consumer at once'
+    )
+    parser.add_argument(
+        '--color',
+        action = 'store_true',
+        help = 'Keep color frames instead of converting to grayscale'
+    )
+    parser.add_argument(
+        '--autoscale',
+        action = 'store_true',
+        help = 'Add or retire consumers at runtime, -n is the initial number'
+    )
+    parser.add_argument(
+        '--shmqueue',
+        action = 'store_true',
+        help = 'Queue script: frames go through shared memory blocks, only descriptors are pickled'
+    )
+    parser.add_argument(
+        '--supervise',
+        type = float,
+        metavar = 'SECONDS',
+        help = 'Replace consumers that crash or spend more than SECONDS on a frame'
+    )
+    parser.add_argument(
+        '--lockfree',
+        action = 'store_true',
+        help = 'Shared memory script: lock-free ring, consumers claim frames with an atomic add (one producer)'
+    )
+    parser.add_argument(
+        '--pin',
+        action = 'store_true',
+        help = 'Pin producers and consumers to disjoint physical cores, memory on their NUMA node'
+    )
+    parser.add_argument(
+        '--huge-pages',
+        choices = ['transparent', 'explicit'],
+        default = None,
+        help = 'Shared memory and asyncio scripts: allocate the ring with 2 MB pages'
+    )
+    parser.add_argument(
+        '--prefault',
+        action = 'store_true',
+        help = 'Shared memory and asyncio scripts: allocate every page of the ring before decoding'
+    )
+    parser.add_argument(
+        '--trace',
+        type = str,
+        default = None,
+        help = 'Record per-stage timings, write a Chrome/Perfetto trace to this file'
+    )
+    parser.add_argument(
+        '--cache',
+        action = 'store_true',
+        help = 'Decode the video once to a disk cache and replay cached frames'
+    )
+    parser.add_argument(
+        '--luma',
+        action = 'store_true',
+        help = 'Grayscale frames are the decoded Y plane, no color conversion'
+    )
+    parser.add_argument(
+        '--pyav',
+        action = 'store_true',
+        help = 'Decode with PyAV (libav) instead of OpenCV'
+    )
+    parser.add_argument(
+        '--threads',
+        type = int,
+        default = 0,
+        help = 'PyAV decoder threads, 0 for auto'
+    )
+    parser.add_argument(
+        '--thread-type',
+        type = str,
+        default = 'AUTO',
+        help = 'PyAV decoder threading: FRAME, SLICE or AUTO'
+    )
+    parser.add_argument(
+        '--keyframes',
+        action = 'store_true',
+        help = 'PyAV: decode keyframes only, for fast previews'
+    )
+    parser.add_argument(
+        '--every',
+        type = int,
+        default = 1,
+        help = 'PyAV: keep one frame out of EVERY'
+    )
+    parser.add_argument(
+        '--roi',
+        type = str,
+        default = None,
+        help = 'Crop frames to x,y,width,height in the producer'
+    )
+    parser.add_argument(
+        '--resize',
+        type = str,
+        default = None,
+        help = 'Resize frames to WIDTHxHEIGHT in the producer'
+    )
+    parser.add_argument(
+        '--bin',
+        type = int,
+        default = 1,
+        help = 'Average NxN pixel blocks in the producer'
+    )
+    parser.add_argument(
+        '--channel',
+        type = str,
+        default = None,
+        help = 'gray, bgr, rgb or a BGR channel index (0, 1, 2)'
+    )
+    parser.add_argument(
+        '--float',
+        action = 'store_true',
+        help = 'Deliver float32 frames'
+    )
+    parser.add_argument(
+        '--normalize',
+        action = 'store_true',
+        help = 'Deliver float32 frames scaled to [0, 1]'
+    )
 
     args = parser.parse_args()
+    if (args.keyframes or args.every > 1) and args.producers > 1:
+        # chunks are cut at frame indices, skipped frames shift the numbers
+        parser.error('--keyframes and --every cannot be used with several producers')
+    if args.autoscale and args.supervise is not None:
+        parser.error('--autoscale and --supervise cannot be combined')
+    if args.autoscale and args.pin:
+        parser.error('--autoscale and --pin cannot be combined')
+    if args.lockfree and (args.producers > 1 or args.autoscale or
+            args.supervise is not None):
+        parser.error('--lockfree has a single producer, without --autoscale or --supervise')
 
     # check that video file exists
     if not os.path.exists(args.videofile):
         raise FileNotFoundError
 
-    if (args.load == "MC"):
-        pfun = synthetic_load_multi_core
-    elif (args.load == "SC"):
-        pfun = synthetic_load_single_core
-    elif (args.load == "L"):
-        pfun = synthetic_load_light
-    elif (args.load == "N"):
-        pfun = do_nothing
-    else:
-        raise ValueError
+    # derived from the options, used as they are by the scripts
+    args.pfun = load_function(args.load)
 
-    return (
-        args.videofile, 
-        args.gpu, 
-        pfun, 
-        args.cvcuda, 
-        args.host, 
-        args.n, 
-        args.queuesize  
-    )
+    args.preprocess = None
+    if (args.roi or args.resize or args.bin > 1 or args.channel or
+            args.float or args.normalize):
+        from preprocessing import Preprocess
+        channel = args.channel
+        if channel is not None and channel.isdigit():
+            channel = int(channel)
+        args.preprocess = Preprocess(
+            roi = tuple(int(x) for x in args.roi.split(',')) if args.roi else None,
+            size = tuple(int(x) for x in args.resize.split('x')) if args.resize else None,
+            binning = args.bin,
+            channel = channel,
+            dtype = np.float32 if args.float or args.normalize else None,
+            normalize = args.normalize
+        )
+
+    args.pyav_options = None
+    if args.pyav:
+        args.pyav_options = {
+            'threads': args.threads,
+            'thread_type': args.thread_type,
+            'keyframes_only': args.keyframes,
+            'every': args.every
+        }
+
+    # keyword arguments of VideoReader.process for the shm ring
+    args.memory = {
+        'huge_pages': args.huge_pages,
+        'prefault': args.prefault
+    }
+
+    return args
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import sys
+import numpy as np
+from video_reader import VideoReader
+from frame_cache import FrameCache
+
+### Check that decoding a video with parallel chunk producers gives exactly
+### the same frames, with the same frame numbers, as a sequential read.
+### With --history K, that every worker sees the right window of K previous
+### frames (single producer). A small --window makes producers of later
+### chunks wait for the results of earlier ones.
+
+def digest(frame, frame_num):
+    return hashlib.sha1(frame.tobytes()).hexdigest().encode()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Compare chunked parallel decoding with a sequential read'
+    )
+    parser.add_argument('videofile', type=str, help='Path to the video')
+    parser.add_argument('-p', '--producers', type=int, default=4)
+    parser.add_argument('-n', type=int, default=2, help='number of consumers')
+    parser.add_argument('-q', '--queuesize', type=int, default=64)
+    parser.add_argument('--transport', type=str, default='shm')
+    parser.add_argument('--color', action='store_true')
+    parser.add_argument('--cache', type=str, help='frame cache directory, replay cached frames')
+    parser.add_argument('--luma', action='store_true', help='read the Y plane of gray frames')
+    parser.add_argument('--history', type=int, default=0, help='check windows of HISTORY previous frames')
+    parser.add_argument('--window', type=int, default=4096, help='results held ahead of the next one in order')
+    args = parser.parse_args()
+
+    options = {'luma': True} if args.luma else {}
+    reader = VideoReader(args.videofile, color=args.color, **options)
+    frames = [frame.copy() for frame_num, frame in reader]
+    expected = [
+        (i + 1, digest(np.stack(frames[max(0, i - args.history):i + 1])
+            if args.history else frames[i], i + 1))
+        for i in range(len(frames))
+    ]
+    if args.history:
+        args.producers = 1
+
+    if args.cache:
+        reader = VideoReader(
+            args.videofile,
+            'cache',
+            color = args.color,
+            cache = FrameCache(args.cache),
+            **options
+        )
+
+    actual = []
+    num_frames = reader.process(
+        digest,
+        args.n,
+        transport = args.transport,
+        queue_size = args.queuesize,
+        n_producers = args.producers,
+        history = args.history,
+        window = args.window,
+        result_dtype = np.dtype('S40'),
+        results = lambda frame_num, result: actual.append((frame_num, bytes(result)))
+    )
+
+    missing = sorted(set(expected) - set(actual))
+    extra = sorted(set(actual) - set(expected))
+    # results are delivered in frame order
+    unordered = sum(a[0] >= b[0] for a, b in zip(actual, actual[1:]))
+
+    print("{0} frames expected, {1} decoded, {2} missing or different, {3} extra, {4} out of order".format(
+        len(expected),
+        num_frames,
+        len(missing),
+        len(extra),
+        unordered
+        )
+    )
+    if missing or extra or unordered or num_frames != len(expected):
+        print("first mismatches: missing {0} extra {1}".format(
+            [n for n, d in missing[:10]],
+            [n for n, d in extra[:10]]
+            )
+        )
+        sys.exit(1)
@@ -0,0 +1,293 @@
+from multiprocessing import Process, Queue
+from multiprocessing.sharedctypes import RawArray
+import glob
+import threading
+import time
+import numpy as np
+import backends
+import frame_layout
+import result_collector
+import video_reader
+from shared_buffer import SharedRingBuffer
+
+### Process many videos through one pipeline. Workers and the shared ring
+### are created once for the whole list, the ring slots are sized for the
+### largest frame. Producers take the next video from a job queue as soon
+### as they finish one, so with several producers the next file is already
+### being decoded while the previous one ends and workers never starve at
+### file boundaries.
+
+PENDING, DECODING, DECODED, FAILED = range(4)
+STATUS = ['pending', 'decoding', 'decoded', 'failed']
+
+def batch_dtype(max_shape, dtype=np.uint8, batch_size=1):
+    '''
+    Return the slot dtype for batches of frames of one video. Frames smaller
+    than max_shape are packed at the beginning of the frame block, see
+    frame_layout.packed
+    '''
+    return np.dtype(
+        [
+            ('video', np.uint32),   # index of the video in the list
+            ('count', np.uint32),   # number of valid frames in the batch
+            ('header', frame_layout.HEADER_DTYPE, (batch_size,)),
+            ('frame', dtype, (batch_size,) + tuple(max_shape)),
+        ]
+    )
+
+def batch_result_dtype(dtype=np.float64):
+    ''' Return the dtype of a results ring slot '''
+    return np.dtype(
+        [('video', np.uint32), ('frame_num', np.uint64), ('result', dtype)]
+    )
+
+class BatchStats:
+
+    def __init__(self, num_videos, max_workers):
+        ''' Per video counters shared by producers and workers '''
+        self.num_videos = num_videos
+        self.status = RawArray('b', num_videos)
+        self.decoded = RawArray('q', num_videos)
+        self.t_start = RawArray('d', num_videos)
+        self.t_decoded = RawArray('d', num_videos)
+        # one row per worker so that workers never write the same counter
+        self.processed = RawArray('q', max_workers*num_videos)
+        self.t_done = RawArray('d', max_workers*num_videos)
+
+    def done(self, worker_num, video, count):
+        i = worker_num*self.num_videos + video
+        self.processed[i] += count
+        self.t_done[i] = time.monotonic()
+
+    def report(self, videos):
+        ''' Return a list with the statistics of each video '''
+        processed = np.frombuffer(self.processed, dtype=np.int64).reshape(
+            -1, self.num_videos
+        )
+        t_done = np.frombuffer(self.t_done).reshape(-1, self.num_videos)
+        report = []
+        for video, videofile in enumerate(videos):
+            frames = int(processed[:, video].sum())
+            seconds = max(0.0, t_done[:, video].max() - self.t_start[video])
+            report.append({
+                'videofile': videofile,
+                'status': STATUS[self.status[video]],
+                'frames': frames,
+                'decode_seconds': max(0.0, self.t_decoded[video] - self.t_start[video]),
+                'seconds': seconds,
+                'fps': frames / seconds if seconds > 0 else 0.0
+            })
+        return report
+
+class VideoBatch:
+
+    def __init__(self, videos, backend='cpu', color=False, **backend_options):
+        '''
+        videos: list of paths, or a glob pattern. Options are the same as
+        for VideoReader.
+        '''
+        if isinstance(videos, str):
+            videos = sorted(glob.glob(videos))
+        self.videos = list(videos)
+        self.backend = backend
+        self.color = color
+        self.backend_options = backend_options
+
+    def probe(self):
+        ''' Return (largest frame shape, dtype) over all videos '''
+        max_shape = None
+        dtype = None
+        for videofile in self.videos:
+            try:
+                source = backends.open_source(
+                    videofile, self.backend, self.color, **self.backend_options
+                )
+            except IOError:
+                # reported as failed when it is processed
+                continue
+            shape = source.shape
+            source.release()
+            if max_shape is None:
+                max_shape, dtype = shape, source.dtype
+            else:
+                max_shape = tuple(max(a, b) for a, b in zip(max_shape, shape))
+        if max_shape is None:
+            raise IOError('none of the videos could be opened')
+        return max_shape, dtype
+
+    def process(
+        self,
+        fn,
+        n_workers = 1,
+        n_producers = 2,
+        queue_size = 256,
+        batch_size = 1,
+        result_dtype = None,
+        results = None,
+        max_shape = None,
+        dtype = np.uint8,
+        verbose = False
+    ):
+        '''
+        Call fn(frame, frame_num) on every frame of every video and return a
+        list of per video statistics (frames, seconds, fps, status).
+
+        n_producers: number of videos decoded at the same time
+        batch_size: as in VideoReader.process, a batch never mixes videos
+        results: callable receiving (videofile, frame_num, result), in frame
+            order for each video. result_dtype is required.
+        max_shape: largest frame shape, probed by opening every video if
+            not given
+        '''
+
+        if results is not None and result_dtype is None:
+            raise ValueError('result_dtype is needed to collect results')
+        if max_shape is None:
+            max_shape, dtype = self.probe()
+
+        num_videos = len(self.videos)
+        stats = BatchStats(num_videos, n_workers)
+        frame_buffer = SharedRingBuffer(
+            queue_size,
+            dtype=batch_dtype(max_shape, dtype, batch_size)
+        )
+        output = None
+        if results is not None:
+            output = SharedRingBuffer(
+                queue_size,
+                dtype=batch_result_dtype(result_dtype)
+            )
+
+        jobs = Queue()
+        for video in range(num_videos):
+            jobs.put(video)
+        for i in range(n_producers):
+            jobs.put(None)
+
+        spec = (self.backend, self.color, self.backend_options)
+        # VideoReader's worker, stats make it read the video of each slot
+        workers = [
+            Process(
+                target=video_reader.shm_worker,
+                args=(frame_buffer, fn, output, i, verbose),
+                kwargs={'stats': stats}
+            )
+            for i in range(n_workers)
+        ]
+        producers = [
+            Process(
+                target=batch_producer,
+                args=(self.videos, spec, jobs, frame_buffer, stats, i, verbose)
+            )
+            for i in range(n_producers)
+        ]
+
+        collector = None
+        if output is not None:
+            collector = threading.Thread(
+                target=_collect,
+                args=(output, self.videos, results)
+            )
+            collector.start()
+
+        tStt = time.monotonic()
+        for p in workers + producers:
+            p.start()
+
+        try:
+            for p in producers:
+                p.join()
+            frame_buffer.close()
+            for p in workers:
+                p.join()
+            if output is not None:
+                output.close()
+                collector.join()
+        except KeyboardInterrupt:
+            for p in producers + workers:
+                p.terminate()
+                p.join()
+            raise
+
+        duration = time.monotonic() - tStt
+        report = stats.report(self.videos)
+        if verbose:
+            for video in report:
+                print("{videofile}: {status}, {frames} frames, {seconds:.3f}s, "
+                    "{fps:.1f} FPS".format(**video))
+            num_frames = sum(video['frames'] for video in report)
+            print("{0} videos, {1} frames, {2:.3f}s, {3:.1f} FPS".format(
+                num_videos,
+                num_frames,
+                duration,
+                num_frames/duration
+                )
+            )
+        return report
+
+def _collect(output, videos, results):
+    # put results back in frame order, video by video
+    reorder = {}
+    while True:
+        ok, index, slot = output.acquire_read_slot(block=True)
+        if not ok:
+            break
+        video = int(slot['video'])
+        frame_num = int(slot['frame_num'])
+        result = slot['result'].copy()
+        output.release(index)
+
+        if video not in reorder:
+            reorder[video] = result_collector.ReorderBuffer()
+        for item in reorder[video].push(frame_num, result):
+            results(videos[video], *item)
+    for video, buffer in sorted(reorder.items()):
+        for item in buffer.flush():
+            results(videos[video], *item)
+
+def batch_producer(videos, spec, jobs, frame_buffer, stats, producer_num,
+                    verbose=False):
+    """decode videos taken from the jobs queue until None is received"""
+
+    backend, color, options = spec
+    slot_size = frame_buffer.dtype['frame'].shape[1:]
+    tStt = time.time()
+    while True:
+        video = jobs.get()
+        if video is None:
+            break
+
+        stats.t_start[video] = time.monotonic()
+        stats.status[video] = DECODING
+        try:
+            source = backends.open_source(videos[video], backend, color, **options)
+        except IOError as e:
+            print("Producer {0}: {1}".format(producer_num, e))
+            stats.status[video] = FAILED
+            continue
+        if len(source.shape) != len(slot_size) or any(
+            a > b for a, b in zip(source.shape, slot_size)):
+            print("Producer {0}: {1} frames {2} do not fit in {3}".format(
+                producer_num, videos[video], source.shape, slot_size
+                )
+            )
+            source.release()
+            stats.status[video] = FAILED
+            continue
+
+        # same decoding loop as VideoReader, slots are tagged with the video
+        num_frames = video_reader.decode_to_ring(
+            source, frame_buffer, 0, None, producer_num, video=video
+        )
+        source.release()
+        stats.decoded[video] = num_frames
+        stats.t_decoded[video] = time.monotonic()
+        stats.status[video] = DECODED
+        if verbose:
+            print("Producer {0} decoded {1} ({2} frames)".format(
+                producer_num, videos[video], num_frames
+                )
+            )
+
+    if verbose:
+        print("Producer {0} time: {1}".format(producer_num,time.time()-tStt))
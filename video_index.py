@@ -0,0 +1,121 @@
+import bisect
+import json
+import os
+
+### Keyframe index of a video, built with a demux pass (no decoding) and
+### stored next to the video as <video>.idx.json, so that random access and
+### chunked decoding do not demux the whole file again.
+
+def keyframes(videofile):
+    '''
+    Return (keyframe indices, number of frames). Packets are demuxed but not
+    decoded, so this is much faster than reading the video, and only once:
+    the result is stored next to the video.
+    '''
+    index = load(videofile)
+    return index['keyframes'], index['num_frames']
+
+def demux(videofile):
+    '''
+    Return (keyframe indices, packet pts in ms) from a single demux pass
+    '''
+
+    import cv2
+
+    # CAP_PROP_FORMAT = -1 returns raw packets instead of decoded frames
+    cap = cv2.VideoCapture(
+        videofile,
+        cv2.CAP_FFMPEG,
+        [cv2.CAP_PROP_FORMAT, -1]
+    )
+    if not cap.isOpened():
+        raise IOError('could not open ' + videofile)
+
+    key_indices = []
+    pts = []
+    while cap.grab():
+        # a keyframe starts a closed GOP: every packet before it in decode
+        # order is displayed before it
+        if cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            key_indices.append(len(pts))
+        pts.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+    cap.release()
+
+    return key_indices, pts
+
+def index_path(videofile):
+    return videofile + '.idx.json'
+
+def build(videofile):
+    '''
+    Demux a video and return its index: keyframe indices, number of frames
+    and pts (ms) of each frame in display order
+    '''
+    key_indices, pts = demux(videofile)
+    stat = os.stat(videofile)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'keyframes': key_indices,
+        'num_frames': len(pts),
+        # packets come in decode order, B-frames are displayed later
+        'pts': sorted(pts)
+    }
+
+def load(videofile, save=True):
+    '''
+    Return the index stored next to the video, rebuild it if it is missing
+    or older than the video
+    '''
+    path = index_path(videofile)
+    stat = os.stat(videofile)
+    if os.path.exists(path):
+        with open(path) as f:
+            index = json.load(f)
+        if (index.get('size') == stat.st_size and
+                index.get('mtime_ns') == stat.st_mtime_ns):
+            return index
+
+    index = build(videofile)
+    if save:
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            # read-only directory, the index is rebuilt next time
+            pass
+    return index
+
+def gop(key_indices, num_frames, frame_index):
+    '''
+    Return (start, stop) of the group of pictures containing frame_index:
+    decoding from the preceding keyframe gives frames start to stop-1
+    '''
+    i = bisect.bisect_right(key_indices, frame_index)
+    start = key_indices[i-1] if i > 0 else 0
+    stop = key_indices[i] if i < len(key_indices) else num_frames
+    return start, stop
+
+def split(key_indices, num_frames, n_chunks):
+    '''
+    Split [0, num_frames) into at most n_chunks (start, stop) ranges of
+    similar length, each starting on a keyframe
+    '''
+
+    if not key_indices or key_indices[0] != 0:
+        key_indices = [0] + list(key_indices)
+
+    starts = []
+    for i in range(n_chunks):
+        target = i * num_frames / n_chunks
+        closest = min(key_indices, key=lambda k: abs(k - target))
+        if closest not in starts:
+            starts.append(closest)
+    starts.sort()
+
+    return [
+        (start, stop)
+        for start, stop in zip(starts, starts[1:] + [num_frames])
+        if stop > start
+    ]
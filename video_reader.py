@@ -0,0 +1,1091 @@
+from multiprocessing import Process, Queue, SimpleQueue
+from multiprocessing.connection import wait
+from multiprocessing.sharedctypes import RawArray
+from collections import OrderedDict
+import functools
+import os
+import threading
+import time
+import numpy as np
+import backends
+import frame_layout
+import placement as cpu_placement
+import ring_memory
+import result_collector
+import shm_queue
+import tracing
+import video_index
+from shared_buffer import SharedRingBuffer
+from lockfree_buffer import LockFreeRingBuffer
+from frame_pool import FramePool
+from autoscale import WorkerControl
+from supervisor import WorkerState
+
+### Library entry point. A VideoReader describes where frames come from
+### (file, backend, color), process() describes how they are distributed to
+### workers. Producers and workers only get their arguments, never module
+### globals, so that they also work with the spawn start method.
+
+class VideoReader:
+
+    # decoded groups of pictures kept by get_frame for neighboring lookups
+    gop_cache_size = 4
+
+    def __init__(self, videofile, backend='cpu', color=False, **backend_options):
+        ''' Nothing is opened until frames are needed '''
+        self.videofile = videofile
+        self.backend = backend
+        self.color = color
+        self.backend_options = backend_options
+        self._info = None
+        # random access: source, next frame index it returns, and
+        # {keyframe index: [frames decoded from it]} in LRU order
+        self._random = None
+        self._random_position = 0
+        self._gops = OrderedDict()
+        # (video mtime, keyframe indices, number of frames), see _keyframes
+        self._index = None
+
+    def open(self):
+        ''' Return a new frame source, see backends.py '''
+        return backends.open_source(
+            self.videofile,
+            self.backend,
+            self.color,
+            **self.backend_options
+        )
+
+    def _probe(self):
+        if self._info is None:
+            source = self.open()
+            self._info = (source.shape, source.dtype, source.num_frames)
+            source.release()
+        return self._info
+
+    @property
+    def shape(self):
+        return self._probe()[0]
+
+    @property
+    def dtype(self):
+        return self._probe()[1]
+
+    @property
+    def num_frames(self):
+        ''' Number of frames announced by the container, may be approximate '''
+        return self._probe()[2]
+
+    def get_frame(self, frame_num):
+        '''
+        Return frame frame_num (starting at 1, like iteration). Decoding starts
+        at the preceding keyframe, found in the index stored next to the video
+        (see video_index.py), and the decoded frames are kept for later calls.
+        Not available when the source skips frames (every, keyframes_only).
+        '''
+        self._check_indexed('get_frame')
+        key_indices, num_frames = self._keyframes()
+        index = frame_num - 1
+        if not 0 <= index < num_frames:
+            raise IndexError('frame {0} out of range'.format(frame_num))
+
+        start, stop = video_index.gop(key_indices, num_frames, index)
+        frames = self._gops.get(start)
+        if frames is None:
+            frames = []
+            self._gops[start] = frames
+            while len(self._gops) > self.gop_cache_size:
+                self._gops.popitem(last=False)
+        self._gops.move_to_end(start)
+
+        if len(frames) <= index - start:
+            if self._random is None:
+                self._random = self.open()
+                self._random_position = 0
+            # continue where the last call stopped if we are still in this
+            # group of pictures, otherwise seek to its keyframe
+            position = start + len(frames)
+            if self._random_position != position:
+                self._random.seek(start)
+                self._random_position = start
+                del frames[:]
+            while len(frames) <= index - start:
+                rval, frame, pts = self._random.read()
+                if not rval:
+                    raise IndexError('frame {0} could not be decoded'.format(frame_num))
+                # some backends reuse their output buffer
+                frames.append(frame.copy())
+                self._random_position += 1
+
+        return frames[index - start]
+
+    def _keyframes(self):
+        # the index file is parsed once, again only if the video changed
+        mtime = os.stat(self.videofile).st_mtime_ns
+        if self._index is None or self._index[0] != mtime:
+            if self._index is not None:
+                # decoded frames belong to the previous file
+                self.close()
+            self._index = (mtime,) + tuple(video_index.keyframes(self.videofile))
+        return self._index[1:]
+
+    def get_range(self, first, stop):
+        ''' Return frames first to stop-1 as a (stop-first, ...) array '''
+        frames = np.empty((stop - first,) + self.shape, self.dtype)
+        for i, frame_num in enumerate(range(first, stop)):
+            frames[i] = self.get_frame(frame_num)
+        return frames
+
+    def close(self):
+        ''' Release the source used for random access '''
+        if self._random is not None:
+            self._random.release()
+            self._random = None
+        self._gops.clear()
+
+    def __iter__(self):
+        ''' Yield (frame_num, frame) sequentially, frame numbers start at 1 '''
+        source = self.open()
+        frame_num = 0
+        try:
+            while True:
+                rval, frame, pts = source.read()
+                if not rval:
+                    break
+                frame_num += 1
+                yield frame_num, frame
+        finally:
+            source.release()
+
+    def process(
+        self,
+        fn,
+        n_workers = 1,
+        transport = 'shm',
+        queue_size = 256,
+        n_producers = 1,
+        batch_size = 1,
+        history = 0,
+        result_dtype = None,
+        results = None,
+        window = 4096,
+        autoscale = None,
+        supervise = None,
+        placement = None,
+        huge_pages = None,
+        prefault = False,
+        trace = None,
+        verbose = False
+    ):
+        '''
+        Call fn(frame, frame_num) on every frame in n_workers processes (or
+        threads) and return the number of frames.
+
+        transport: 'queue' sends frames through a multiprocessing Queue,
+            'shm' through a SharedRingBuffer, workers process frames in place.
+            'threads' runs producers and workers as threads of this process
+            sharing a preallocated FramePool, without any copy; use it when
+            fn releases the GIL (OpenCV, numpy/BLAS).
+            'shmqueue' has the semantics of 'queue' but frames are copied
+            into a pool of shared memory blocks and only small descriptors
+            are pickled, see shm_queue.SharedMemoryQueue.
+            'mmap' needs backend='cache': each worker maps the cached frames
+            and processes its own contiguous share, there is no producer.
+            'lockfree' is 'shm' on a lockfree_buffer.LockFreeRingBuffer,
+            workers claim slots with an atomic add instead of a lock. One
+            producer, no history, supervise or autoscale.
+        n_producers: decode keyframe-aligned chunks of the video in parallel,
+            not with sources that skip frames (every, keyframes_only)
+        batch_size: deliver blocks of consecutive frames, fn is then called
+            as fn(frames, frame_nums) with a (count, ...) array of count <=
+            batch_size frames, and returns one result per frame if any.
+            queue_size counts batches.
+        history: temporal windows, fn(frames, frame_num) gets frames
+            [frame_num-history, frame_num] as a (count, ...) array, fewer at
+            the beginning of the video. The frames stay in the ring until
+            every window using them is done, no frame is copied ('shm'
+            with a single producer and batch_size 1 only).
+        results: if given, values returned by fn are collected in frame order
+            and passed to this callable as (frame_num, result), or written
+            to this path. result_dtype (dtype of one result) is required for
+            'shm', 'threads' and when writing to a file. Frames whose result
+            never arrived raise RuntimeError at the end, after every other
+            result was delivered.
+        window: with several producers (or 'mmap' workers) and results,
+            results of later chunks are held until the earlier chunks are
+            done. Later chunks pause when they get window frames ahead of
+            the next result in order, bounding what is held, see
+            result_collector.ReorderWindow. None holds everything.
+        autoscale: an autoscale.Autoscaler, n_workers is then the initial
+            number of workers and workers are added or retired while frames
+            are decoded ('shm' only)
+        supervise: a supervisor.Supervisor, workers that crash or hang are
+            replaced and the frames they held are processed again ('shm' and
+            'queue'). Frames given up on are listed in supervise.failed
+        placement: a placement.Placement, producers and workers are pinned
+            to disjoint physical cores with matching BLAS threads and shared
+            memory is allocated on the workers' NUMA node (processes only,
+            not with autoscale)
+        huge_pages, prefault: how the 'shm' ring is allocated, see
+            ring_memory.RingMemory. queue_size can also be given in bytes,
+            e.g. '8G', and a warning is issued when the frames queued do not
+            fit in available memory.
+        trace: a tracing.Tracer recording per-frame timestamps of every
+            pipeline stage, see Tracer.summary and Tracer.export_chrome
+        '''
+
+        if results is not None and result_dtype is None and (
+            transport in ('shm', 'lockfree', 'threads') or
+            isinstance(results, str)):
+            raise ValueError('result_dtype is needed to collect results')
+        if result_dtype is not None:
+            result_dtype = result_collector.result_dtype((), result_dtype)
+        if transport == 'lockfree' and n_producers != 1:
+            raise ValueError('the lockfree ring has a single producer')
+        if autoscale is not None and transport != 'shm':
+            raise ValueError('autoscale requires the shm transport')
+        if supervise is not None and transport not in ('shm', 'queue'):
+            raise ValueError('supervise requires the shm or queue transport')
+        if supervise is not None and autoscale is not None:
+            raise ValueError('autoscale and supervise cannot be combined')
+        if placement is not None and transport == 'threads':
+            raise ValueError('placement requires worker processes')
+        if placement is not None and autoscale is not None:
+            raise ValueError('autoscale and placement cannot be combined')
+        if transport != 'mmap':
+            queue_size = ring_memory.capacity(
+                queue_size,
+                frame_layout.batch_dtype(self.shape, self.dtype, batch_size).itemsize
+            )
+        if history:
+            if transport != 'shm' or n_producers != 1 or batch_size != 1:
+                raise ValueError('history requires the shm transport, one '
+                    'producer and batch_size 1')
+            if supervise is not None:
+                raise ValueError('history and supervise cannot be combined')
+            # every worker can hold a window, one slot is always empty
+            if queue_size < history + n_workers + 2:
+                raise ValueError('queue_size must be at least history + '
+                    'n_workers + 2')
+        if supervise is not None and transport == 'queue':
+            # lost frames are decoded again with get_frame
+            self._check_indexed("supervise with the queue transport")
+        state = None
+        requeue = None
+        if supervise is not None and transport == 'queue':
+            # frames begun are recorded, to find those lost in a dequeue
+            state = WorkerState(n_workers, self._keyframes()[1])
+        elif supervise is not None:
+            state = WorkerState(n_workers)
+
+        if transport == 'mmap':
+            # workers read their own share of the cache, no producer
+            ranges = self._cached_chunks(n_workers)
+        else:
+            ranges = self._chunks(n_producers)
+        frame_counts = RawArray('q', len(ranges))
+        reorder_window = None
+        if results is not None and window is not None and len(ranges) > 1:
+            reorder_window = result_collector.ReorderWindow(window)
+
+        plan = None
+        if placement is not None:
+            plan = placement.plan(
+                0 if transport == 'mmap' else len(ranges),
+                n_workers
+            )
+            if verbose:
+                print(plan)
+
+        def new_process(target, args, worker=None, producer=None):
+            if plan is None:
+                return Process(target=target, args=args)
+            if worker is not None:
+                cpus, threads = plan.workers[worker], plan.threads[worker]
+            else:
+                cpus, threads = plan.producers[producer], None
+            return Process(
+                target=cpu_placement.run_pinned,
+                args=(cpus, threads, target, args)
+            )
+
+        if transport in ('shm', 'lockfree'):
+            ring = SharedRingBuffer
+            if transport == 'lockfree':
+                ring = LockFreeRingBuffer
+            with cpu_placement.memory_on(plan):
+                # pages go to the node of the cpu touching them first
+                frame_buffer = ring(
+                    queue_size,
+                    dtype=frame_layout.batch_dtype(self.shape, self.dtype, batch_size),
+                    huge_pages=huge_pages,
+                    prefault=prefault or plan is not None
+                )
+                output = None
+                if results is not None:
+                    output = SharedRingBuffer(queue_size, dtype=result_dtype)
+            control = None
+            if autoscale is not None:
+                control = WorkerControl(max(n_workers, autoscale.max_workers))
+                if autoscale.split_threads:
+                    control.blas_threads.value = \
+                        autoscale.threads_per_worker(n_workers)
+
+            def new_worker(i, retry=None):
+                return new_process(
+                    shm_worker,
+                    (frame_buffer, fn, output, i, verbose, control, trace,
+                        state, retry, history),
+                    worker=i
+                )
+            workers = [new_worker(i) for i in range(n_workers)]
+            producers = [
+                new_process(
+                    shm_producer,
+                    (self._spec(), start, stop, frame_buffer, frame_counts, i,
+                        verbose, trace, history, reorder_window),
+                    producer=i
+                )
+                for i, (start, stop) in enumerate(ranges)
+            ]
+            stream = None
+            if output is not None:
+                stream = result_collector.ring_results(output)
+            occupancy = lambda: frame_buffer.size()/frame_buffer.maxNumItems
+
+        elif transport == 'threads':
+            frame_buffer = FramePool(
+                queue_size,
+                frame_layout.batch_dtype(self.shape, self.dtype, batch_size)
+            )
+            output = None
+            if results is not None:
+                output = FramePool(queue_size, result_dtype)
+            # same loops as 'shm', the pool has the same slot API
+            workers = [
+                threading.Thread(
+                    target=shm_worker,
+                    args=(frame_buffer, fn, output, i, verbose, None, trace),
+                    daemon=True
+                )
+                for i in range(n_workers)
+            ]
+            producers = [
+                threading.Thread(
+                    target=shm_producer,
+                    args=(self._spec(), start, stop, frame_buffer,
+                            frame_counts, i, verbose, trace, 0, reorder_window),
+                    daemon=True
+                )
+                for i, (start, stop) in enumerate(ranges)
+            ]
+            stream = None
+            if output is not None:
+                stream = result_collector.ring_results(output)
+            occupancy = lambda: frame_buffer.size()/frame_buffer.maxNumItems
+
+        elif transport == 'mmap':
+            output = None
+            if results is not None:
+                output = Queue()
+            entry = self._cache_entry()
+            workers = [
+                new_process(
+                    mmap_worker,
+                    (entry, start, stop, fn, output, frame_counts, i,
+                        batch_size, verbose, trace, reorder_window),
+                    worker=i
+                )
+                for i, (start, stop) in enumerate(ranges)
+            ]
+            producers = []
+            stream = None
+            if output is not None:
+                stream = result_collector.queue_results(output)
+            occupancy = lambda: 0.0
+
+        elif transport in ('queue', 'shmqueue'):
+            if transport == 'shmqueue':
+                frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+                # blocks queued, held by each worker while it gets the next
+                # item, and being filled by producers
+                with cpu_placement.memory_on(plan):
+                    frame_queue = shm_queue.SharedMemoryQueue(
+                        queue_size,
+                        batch_size*frame_bytes + shm_queue.ALIGN,
+                        n_blocks = queue_size + 2*n_workers + len(ranges)
+                    )
+            else:
+                frame_queue = Queue(maxsize = queue_size)
+            output = None
+            if results is not None and supervise is not None:
+                # Queue.put hands results to a feeder thread, they would be
+                # lost with a worker killed before it flushed them
+                output = SimpleQueue()
+            elif results is not None:
+                output = Queue()
+            def new_worker(i, retry=None):
+                return new_process(
+                    queue_worker,
+                    (frame_queue, fn, output, i, batch_size, verbose, trace,
+                        state, retry),
+                    worker=i
+                )
+            workers = [new_worker(i) for i in range(n_workers)]
+            producers = [
+                new_process(
+                    queue_producer,
+                    (self._spec(), start, stop, frame_queue, frame_counts, i,
+                        queue_size, batch_size, verbose, trace, reorder_window),
+                    producer=i
+                )
+                for i, (start, stop) in enumerate(ranges)
+            ]
+            stream = None
+            if output is not None:
+                stream = result_collector.queue_results(output)
+            occupancy = lambda: frame_queue.qsize()/queue_size
+
+            def requeue():
+                # queue the frames no worker began, in runs of consecutive
+                # frames, followed by the end of stream
+                unseen = []
+                for i, (start, stop) in enumerate(ranges):
+                    unseen += state.unseen(range(start + 1, start + frame_counts[i] + 1))
+                runs = []
+                for frame_num in unseen:
+                    if runs and runs[-1][-1] == frame_num - 1 and len(runs[-1]) < batch_size:
+                        runs[-1].append(frame_num)
+                    else:
+                        runs.append([frame_num])
+                queued = 0
+                for frame_nums in runs:
+                    item = None
+                    if supervise.retry(frame_nums):
+                        item = self._redecode(frame_nums, batch_size)
+                    if item is None:
+                        supervise.give_up(frame_nums)
+                        for frame_num in frame_nums:
+                            state.seen[frame_num] = 1
+                        continue
+                    frame_queue.put(item)
+                    queued += 1
+                if queued:
+                    frame_queue.put(None)
+                return queued > 0
+
+        else:
+            raise ValueError('unknown transport ' + str(transport))
+
+        collector = None
+        missing = []
+        if stream is not None:
+            collector = threading.Thread(
+                target=_collect,
+                args=(stream, results, result_dtype,
+                        None if supervise is None else supervise.failed,
+                        reorder_window, missing)
+            )
+            collector.start()
+
+        if trace is not None:
+            trace.start_monitor(occupancy, verbose)
+
+        def end_of_stream():
+            # no more frames: drain then stop the workers
+            if transport in ('shm', 'lockfree', 'threads'):
+                frame_buffer.close()
+            elif transport in ('queue', 'shmqueue'):
+                for i in range(n_workers):
+                    frame_queue.put(None)
+
+        for p in workers + producers:
+            p.start()
+
+        try:
+            if autoscale is not None:
+                self._autoscale(
+                    autoscale, control, frame_buffer, producers, workers,
+                    new_worker, verbose
+                )
+            if supervise is not None:
+                self._supervise(
+                    supervise, state, producers, workers, new_worker,
+                    end_of_stream,
+                    frame_buffer if transport == 'shm' else None,
+                    batch_size, verbose, requeue
+                )
+            else:
+                for p in producers:
+                    p.join()
+                end_of_stream()
+                for p in workers:
+                    p.join()
+            if output is not None and transport in ('shm', 'lockfree', 'threads'):
+                output.close()
+            elif output is not None:
+                output.put(None)
+            if collector is not None:
+                collector.join()
+        except KeyboardInterrupt:
+            if trace is not None:
+                trace.stop_monitor()
+            if transport == 'threads':
+                # threads cannot be killed, they are daemons
+                frame_buffer.close()
+                raise
+            for p in producers + workers:
+                p.terminate()
+                p.join()
+            raise
+
+        if trace is not None:
+            trace.stop_monitor()
+        if supervise is not None and verbose:
+            print(supervise.report())
+        if missing:
+            raise RuntimeError('no result for {0} frames: {1}{2}'.format(
+                len(missing),
+                missing[:10],
+                '...' if len(missing) > 10 else ''
+                )
+            )
+        return sum(frame_counts)
+
+    def _autoscale(self, autoscale, control, frame_buffer, producers, workers,
+                    new_worker, verbose):
+        # add or retire workers until all frames are decoded. Retired
+        # workers finish their current frame and exit, they stay in workers
+        # so that they are joined with the others.
+        active = list(range(len(workers)))
+        by_num = dict(enumerate(workers))
+        while any(p.is_alive() for p in producers):
+            # returns as soon as a producer exits
+            ready = wait([p.sentinel for p in producers if p.is_alive()],
+                    timeout=autoscale.interval)
+            for p in producers:
+                if p.sentinel in ready:
+                    p.join()
+            if not any(p.is_alive() for p in producers):
+                break
+            decision = autoscale.step(
+                frame_buffer, len(producers), len(active)
+            )
+            if decision > 0:
+                # a retired worker number is reused once its process exited
+                free = [
+                    i for i in range(len(control.stop_flags))
+                    if i not in active
+                    and (i not in by_num or not by_num[i].is_alive())
+                ]
+                if not free:
+                    continue
+                i = free[0]
+                control.stop_flags[i] = 0
+                p = new_worker(i)
+                p.start()
+                workers.append(p)
+                by_num[i] = p
+                active.append(i)
+            elif decision < 0:
+                i = active.pop()
+                control.stop_flags[i] = 1
+            if decision != 0 and autoscale.split_threads:
+                control.blas_threads.value = \
+                    autoscale.threads_per_worker(len(active))
+            if decision != 0 and verbose:
+                t, n, occupancy, stall, idle = autoscale.history[-1]
+                print("Autoscale: {0} -> {1} workers (buffer {2:.0f}%, "
+                    "producer stall {3:.0f}%, consumer idle {4:.0f}%)".format(
+                    n, len(active), 100*occupancy, 100*stall, 100*idle
+                    )
+                )
+
+    def _supervise(self, supervise, state, producers, workers, new_worker,
+                    end_of_stream, frame_buffer, batch_size, verbose,
+                    requeue=None):
+        # wait for the producers then for the workers, replacing workers
+        # that die. Sentinels wake us up as soon as a process exits, the
+        # timeout is only there to look for hung workers. requeue queues
+        # the frames taken by workers that died before recording them.
+        active = dict(enumerate(workers))
+        stopped = False
+        lost = None
+        while active:
+            if not stopped and not any(p.is_alive() for p in producers):
+                end_of_stream()
+                stopped = True
+            sentinels = [p.sentinel for p in active.values()]
+            sentinels += [p.sentinel for p in producers if p.is_alive()]
+            wait(sentinels, timeout=supervise.timeout/4)
+
+            for i, p in list(active.items()):
+                if p.is_alive():
+                    if not state.hung(i, supervise.timeout):
+                        continue
+                    if verbose:
+                        print("Worker {0} hung, killing it".format(i))
+                    p.kill()
+                p.join()
+                del active[i]
+                if p.exitcode == 0:
+                    continue
+
+                if supervise.restarts >= supervise.max_restarts:
+                    for p in producers + workers:
+                        p.terminate()
+                        p.join()
+                    raise RuntimeError('too many worker failures, ' + supervise.report())
+                supervise.restarts += 1
+
+                # hand the item the worker was holding to its replacement
+                retry = None
+                with state.lock:
+                    item = state.in_flight(i)
+                    if item is None and state.taking[i]:
+                        lost = i
+                    state.end(i)
+                if item is not None:
+                    slot, frame_nums = item
+                    if supervise.retry(frame_nums):
+                        if frame_buffer is not None:
+                            retry = slot
+                        else:
+                            retry = self._redecode(frame_nums, batch_size)
+                    if retry is None:
+                        supervise.give_up(frame_nums)
+                        if frame_buffer is not None:
+                            frame_buffer.release(slot)
+                if verbose:
+                    print("Worker {0} died (exit code {1}), restarting it".format(
+                        i, p.exitcode
+                        )
+                    )
+                p = new_worker(i, retry)
+                p.start()
+                workers.append(p)
+                active[i] = p
+
+            if not active and lost is not None and requeue is not None:
+                # every other frame was begun, decode the missing ones
+                # again for one last worker
+                i, lost = lost, None
+                if requeue():
+                    p = new_worker(i)
+                    p.start()
+                    workers.append(p)
+                    active[i] = p
+
+    def _redecode(self, frame_nums, batch_size):
+        # queue items are lost with their worker, decode the frames again
+        try:
+            frames = self.get_range(frame_nums[0], frame_nums[-1] + 1)
+        except (IndexError, IOError, NotImplementedError):
+            return None
+        finally:
+            # the random access source is not needed after the run
+            self.close()
+        if batch_size == 1:
+            return (frames[0], frame_nums[0])
+        return (frames, np.array(frame_nums))
+
+    def _cache_entry(self):
+        # decodes the video into the cache on first use
+        if self.backend != 'cache':
+            raise ValueError("the mmap transport requires backend='cache'")
+        source = self.open()
+        entry = source.entry
+        source.release()
+        return entry
+
+    def _cached_chunks(self, n_workers):
+        num_frames = self._cache_entry()['num_frames']
+        bounds = np.linspace(0, num_frames, n_workers + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _decimated(self):
+        # frames are numbered in delivery order, not by their index in the video
+        options = self.backend_options
+        return options.get('every', 1) > 1 or bool(options.get('keyframes_only'))
+
+    def _check_indexed(self, what):
+        if self._decimated():
+            raise ValueError(
+                '{0} needs every frame of the video, it cannot be used with '
+                'every or keyframes_only'.format(what)
+            )
+
+    def _spec(self):
+        # what a child process needs to open its own source
+        return (self.videofile, self.backend, self.color, self.backend_options)
+
+    def _chunks(self, n_producers):
+        # [(start, stop)] frame ranges, stop None means until the end
+        if n_producers <= 1:
+            return [(0, None)]
+        # chunk bounds are frame indices of the video
+        self._check_indexed('n_producers > 1')
+        key_indices, num_frames = self._keyframes()
+        return video_index.split(key_indices, num_frames, n_producers)
+
+def _open_at(spec, start):
+    videofile, backend, color, options = spec
+    source = backends.open_source(videofile, backend, color, **options)
+    if start > 0:
+        source.seek(start)
+    return source
+
+def _collect(stream, results, dtype, failed=None, window=None, missing=None):
+    ordered = result_collector.ordered(stream, failed=failed, window=window,
+                                        missing=missing)
+    if isinstance(results, str):
+        result_collector.write_results(ordered, results, dtype)
+    else:
+        for frame_num, result in ordered:
+            results(frame_num, result)
+
+def _emit_results(output, frame_nums, result, batch_size, put):
+    # one result per frame, fn returns a sequence of results for a batch
+    if output is None:
+        return
+    if batch_size == 1:
+        put(output, frame_nums, result)
+    else:
+        for frame_num, frame_result in zip(frame_nums, result):
+            put(output, int(frame_num), frame_result)
+
+def _queue_put(output_queue, frame_num, result):
+    output_queue.put((frame_num, result))
+
+def shm_producer(spec, start, stop, frame_buffer, frame_counts, producer_num,
+                    verbose=False, trace=None, history=0, window=None):
+    """
+    decode frames [start, stop) directly into the shared buffer, each slot
+    holds a batch of up to batch_size consecutive frames. With history,
+    each frame is kept for the windows of the next history frames. window
+    (result_collector.ReorderWindow) paces chunks ahead of the results.
+    """
+
+    source = _open_at(spec, start)
+    tStt = time.time()
+    frame_counts[producer_num] = decode_to_ring(
+        source, frame_buffer, start, stop, producer_num, verbose, trace,
+        history, window=window
+    )
+    source.release()
+    if verbose:
+        print("Producer {0} time: {1}".format(producer_num,time.time()-tStt))
+
+def decode_to_ring(source, frame_buffer, start, stop, producer_num,
+                    verbose=False, trace=None, history=0, video=None,
+                    window=None):
+    """
+    decode frames [start, stop) of an open source into the shared buffer
+    and return the number of frames decoded. Frames smaller than the slot
+    are packed at its beginning. video: index stored in each slot when
+    frames of several videos share the buffer, see video_batch.py.
+    """
+
+    batch_size = frame_buffer.dtype['frame'].shape[0]
+    frame_num = start
+    done = False
+    while not done:
+        if window is not None:
+            # before taking a slot: slots are published in order, a slot
+            # held here would hide the frames of the earlier chunks
+            window.wait(frame_num + batch_size, start)
+        tWait = time.monotonic()
+        ok, index, slot = frame_buffer.acquire_write_slot(block=True)
+        if trace is not None:
+            trace.producer_wait(producer_num, time.monotonic() - tWait)
+        if video is not None:
+            slot['video'] = video
+        frames = frame_layout.packed(slot['frame'], (batch_size,) + source.shape)
+        count = 0
+        while count < batch_size:
+            if stop is not None and frame_num >= stop:
+                done = True
+                break
+            tRead = time.monotonic()
+            rval, frame, pts = source.read(frames[count])
+            if not rval:
+                done = True
+                break
+
+            # frame numbers count from the beginning of the video, from 1
+            frame_num += 1
+            if trace is not None:
+                trace.decoded(frame_num, producer_num, tRead, source.decode_ts)
+            frame_layout.fill_header(
+                slot['header'][count],
+                frames[count],
+                frame_num,
+                pts,
+                time.monotonic()
+            )
+            count += 1
+
+        # a batch can be partial or even empty at the end of the video
+        slot['count'] = count
+        if history and count > 0:
+            # used by the windows of this frame and of the next history ones
+            frame_buffer.retain(index, history + 1)
+        # stamped before commit, a worker can dequeue the slot right after
+        if trace is not None:
+            trace.stamp_many(
+                range(frame_num - count + 1, frame_num + 1), tracing.ENQUEUE
+            )
+        frame_buffer.commit(index)
+
+        # Monitor the state of the queue
+        if verbose and count > 0 and (frame_num // batch_size % 100) == 0:
+            print("Frame {0}, Frame buffer usage: {1}%".format(
+                frame_num,
+                100*frame_buffer.size()/frame_buffer.maxNumItems
+                )
+            )
+
+    return frame_num - start
+
+def shm_worker(frame_buffer, process_fun, output_buffer, process_num,
+                verbose=False, control=None, trace=None, state=None,
+                retry=None, history=0, stats=None):
+    """
+    process frames in place in shared memory until the buffer is closed, or
+    until control (autoscale.WorkerControl) asks this worker to stop.
+    With batches, process_fun gets a (count, ...) view and the frame numbers.
+    With history, process_fun gets frames [n-history, n] of the window of
+    frame n, see _window.
+    state (supervisor.WorkerState) records the slot being processed, retry
+    is a slot left leased by a worker that died, processed first.
+    stats (video_batch.BatchStats): slots hold frames of several videos,
+    results are tagged with the video and frames counted per video.
+    """
+
+    batch_size = frame_buffer.dtype['frame'].shape[0]
+    tStt = time.time()
+    while True:
+        if control is not None:
+            if control.should_stop(process_num):
+                break
+            control.apply_threads()
+
+        tWait = time.monotonic()
+        if retry is not None:
+            ok, index, slot = True, retry, frame_buffer.slots()[retry]
+            retry = None
+        else:
+            ok, index, slot = frame_buffer.acquire_read_slot(block=True)
+        tGot = time.monotonic()
+        if not ok:
+            # end of stream
+            break
+
+        count = int(slot['count'])
+        if count == 0:
+            # empty slot left by a producer at the end of the video
+            frame_buffer.release(index)
+            continue
+        if state is not None:
+            state.begin(process_num, index, int(slot['header']['index'][0]), count)
+
+        if trace is not None:
+            trace.worker_wait(process_num, tGot - tWait)
+            trace.dequeued(slot['header']['index'][:count], process_num, tGot)
+
+        frames = slot['frame']
+        put = result_collector.write_result
+        if stats is not None:
+            # frames of each video are packed at the beginning of the slot
+            video = int(slot['video'])
+            shape = frame_layout.frame_shape(slot['header'][0])
+            frames = frame_layout.packed(frames, (count,) + shape)
+            put = functools.partial(result_collector.write_result, video=video)
+
+        # do some processing
+        if history:
+            frame_nums = int(slot['header']['index'][0])
+            indices, frames = _window(frame_buffer, index, frame_nums, history)
+            result = process_fun(frames,frame_nums)
+        elif batch_size == 1:
+            frame_nums = int(slot['header']['index'][0])
+            result = process_fun(frames[0],frame_nums)
+        else:
+            frame_nums = slot['header']['index'][:count].copy()
+            result = process_fun(frames[:count],frame_nums)
+        if trace is not None:
+            trace.stamp_many(np.atleast_1d(frame_nums), tracing.PROCESS)
+
+        _emit_results(output_buffer, frame_nums, result, batch_size, put)
+        # released once the results are out, so that a worker dying before
+        # that leaves the frames in the slot for its replacement. The slot
+        # and the item end together: a slot given back is never retried.
+        if state is not None:
+            state.lock.acquire()
+        if history:
+            frame_buffer.unref(indices)
+        else:
+            frame_buffer.release(index)
+        if state is not None:
+            state.end(process_num)
+            state.lock.release()
+        if stats is not None:
+            stats.done(process_num, video, count)
+        if trace is not None:
+            trace.stamp_many(np.atleast_1d(frame_nums), tracing.DONE)
+
+    if verbose:
+        print("Consumer {0} time: {1}".format(process_num,time.time()-tStt))
+
+def _window(frame_buffer, index, frame_num, history):
+    '''
+    Return (slot indices, frames) of the window ending with frame frame_num
+    in slot index: a (min(history, frame_num-1) + 1, ...) array, oldest frame
+    first. With a single producer the previous frames are in the previous
+    slots, kept alive by their references. The window is a view of the
+    ring, or a copy when it wraps around the end of the ring.
+    '''
+    length = min(history, frame_num - 1) + 1
+    first = index - length + 1
+    frames = frame_buffer.slots()['frame']
+    if first >= 0:
+        return range(first, index + 1), frames[first:index + 1, 0]
+    indices = [i % frame_buffer.maxNumItems for i in range(first, index + 1)]
+    return indices, frames[indices, 0]
+
+def queue_producer(spec, start, stop, frame_queue, frame_counts, producer_num,
+                    queue_size, batch_size=1, verbose=False, trace=None,
+                    window=None):
+    """
+    decode frames [start, stop) and put them in a queue, one item per frame
+    or per (batch_size, ...) block of frames
+    """
+
+    source = _open_at(spec, start)
+    tStt = time.time()
+    frame_num = start
+    done = False
+    while not done:
+        if batch_size == 1:
+            frames = None
+        else:
+            frames = np.empty((batch_size,) + source.shape, source.dtype)
+        frame_nums = []
+        while len(frame_nums) < batch_size:
+            if stop is not None and frame_num >= stop:
+                done = True
+                break
+            if window is not None:
+                window.wait(frame_num + 1, start)
+            out = None if frames is None else frames[len(frame_nums)]
+            tRead = time.monotonic()
+            rval, frame, pts = source.read(out)
+            if not rval:
+                done = True
+                break
+            frame_num += 1
+            frame_nums.append(frame_num)
+            if trace is not None:
+                trace.decoded(frame_num, producer_num, tRead, source.decode_ts)
+
+        if not frame_nums:
+            break
+
+        # Push data to the Queue. WARNING sending large data (High-res image or
+        # RGBA vs grayscale) will clog the queue
+        tWait = time.monotonic()
+        if batch_size == 1:
+            frame_queue.put((frame, frame_nums[0]))
+        else:
+            frame_queue.put((frames[:len(frame_nums)], np.array(frame_nums)))
+        if trace is not None:
+            trace.producer_wait(producer_num, time.monotonic() - tWait)
+            trace.stamp_many(frame_nums, tracing.ENQUEUE)
+
+        # Monitor the state of the queue
+        if verbose and (frame_num // batch_size % 100) == 0:
+            print("Frame {0}, Frame queue usage: {1}%".format(
+                frame_num,
+                100*frame_queue.qsize()/queue_size
+                )
+            )
+
+    source.release()
+    frame_counts[producer_num] = frame_num - start
+    if verbose:
+        print("Producer {0} time: {1}".format(producer_num,time.time()-tStt))
+
+def queue_worker(frame_queue, process_fun, output_queue, process_num,
+                    batch_size=1, verbose=False, trace=None, state=None,
+                    retry=None):
+    """
+    process frames from the queue until None is received. state
+    (supervisor.WorkerState) records the frames being processed, retry is
+    an item whose worker died, processed first.
+    """
+
+    tStt = time.time()
+    while True:
+        tWait = time.monotonic()
+        if retry is not None:
+            item, retry = retry, None
+        else:
+            if state is not None:
+                # an item taken but not begun yet is found by the supervisor
+                state.take(process_num)
+            item = frame_queue.get()
+        tGot = time.monotonic()
+        if item is None:
+            break
+        frame, frame_num = item
+        if state is not None:
+            frame_nums = np.atleast_1d(frame_num)
+            state.begin(process_num, -1, int(frame_nums[0]), len(frame_nums))
+        if trace is not None:
+            trace.worker_wait(process_num, tGot - tWait)
+            trace.dequeued(np.atleast_1d(frame_num), process_num, tGot)
+
+        # do some processing
+        result = process_fun(frame,frame_num)
+        if trace is not None:
+            trace.stamp_many(np.atleast_1d(frame_num), tracing.PROCESS)
+        _emit_results(output_queue, frame_num, result, batch_size, _queue_put)
+        if state is not None:
+            state.end(process_num)
+        if trace is not None:
+            trace.stamp_many(np.atleast_1d(frame_num), tracing.DONE)
+
+    if verbose:
+        print("Consumer {0} time: {1}".format(process_num,time.time()-tStt))
+
+def mmap_worker(entry, start, stop, process_fun, output_queue, frame_counts,
+                    process_num, batch_size=1, verbose=False, trace=None,
+                    window=None):
+    """process frames [start, stop) of a frame_cache entry, mapped directly"""
+
+    import frame_cache
+    frames = frame_cache.open_frames(entry)
+    tStt = time.time()
+    for first in range(start, stop, batch_size):
+        last = min(first + batch_size, stop)
+        if window is not None:
+            window.wait(last, start)
+        # frame numbers start at 1
+        frame_nums = np.arange(first + 1, last + 1)
+        if trace is not None:
+            trace.dequeued(frame_nums, process_num, time.monotonic())
+
+        if batch_size == 1:
+            frame_num = first + 1
+            result = process_fun(frames[first], frame_num)
+        else:
+            frame_num = frame_nums
+            result = process_fun(frames[first:last], frame_nums)
+        if trace is not None:
+            trace.stamp_many(frame_nums, tracing.PROCESS)
+        _emit_results(output_queue, frame_num, result, batch_size, _queue_put)
+        if trace is not None:
+            trace.stamp_many(frame_nums, tracing.DONE)
+
+    frame_counts[process_num] = stop - start
+    if verbose:
+        print("Consumer {0} time: {1}".format(process_num,time.time()-tStt))